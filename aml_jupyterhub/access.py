@@ -0,0 +1,100 @@
+"""An index of the projects (Resource Groups) each user has a role on."""
+
+import logging
+import threading
+
+# Stands for every Resource Group, for roles assigned on the subscription or above.
+ALL_RESOURCE_GROUPS = "*"
+
+
+def list_role_assignments(auth_mgmt_client):
+    """
+    Return every role assignment in the subscription as `(id, principal_id, scope,
+    role_definition_id)`. This pages through all of them, so go through
+    `AMLSpawner.project_access_cache` instead.
+    """
+    return [(ra.id, ra.principal_id, ra.scope, ra.role_definition_id)
+            for ra in auth_mgmt_client.role_assignments.list()]
+
+
+def resource_group_of(scope, subscription_id):
+    """
+    Return the (lower case) Resource Group that a role assignment at `scope` applies to,
+    ALL_RESOURCE_GROUPS for the subscription or above, or None for another subscription.
+    """
+    parts = scope.strip("/").lower().split("/")
+    if parts == [""] or parts[0] == "providers":
+        # The root scope, or a management group.
+        return ALL_RESOURCE_GROUPS
+    if parts[:2] != ["subscriptions", subscription_id.lower()]:
+        return None
+    if len(parts) == 2:
+        return ALL_RESOURCE_GROUPS
+    if len(parts) >= 4 and parts[2] == "resourcegroups":
+        # Including resources in the Resource Group, e.g. its AzureML workspace.
+        return parts[3]
+    return None
+
+
+class ProjectAccessIndex:
+    """
+    The Resource Groups each principal (user or group object ID) has a role on.
+
+    `update` is given all the role assignments in the subscription, and applies only the
+    ones added or removed since the last update, so looking a user up is a dict lookup.
+    If `roles` is given, only assignments of those role definitions (by GUID) count.
+
+    """
+    def __init__(self, subscription_id, roles=(), log=None):
+        self.subscription_id = subscription_id
+        self.roles = {role.lower() for role in roles}
+        self.log = log or logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        # Assignment ID -> (principal ID, Resource Group).
+        self._assignments = {}
+        # Principal ID -> {Resource Group: number of assignments giving access to it}.
+        self._access = {}
+
+    def _resource_group(self, scope, role_definition_id):
+        if self.roles and role_definition_id.rsplit("/", 1)[-1].lower() not in self.roles:
+            return None
+        return resource_group_of(scope, self.subscription_id)
+
+    def update(self, assignments):
+        """Bring the index up to date with `assignments`. Returns the index itself."""
+        latest = {}
+        for assignment_id, principal_id, scope, role_definition_id in assignments:
+            resource_group = self._resource_group(scope, role_definition_id)
+            if resource_group is not None:
+                latest[assignment_id] = (principal_id, resource_group)
+        with self._lock:
+            removed = self._assignments.keys() - latest.keys()
+            added = latest.keys() - self._assignments.keys()
+            for assignment_id in removed:
+                principal_id, resource_group = self._assignments.pop(assignment_id)
+                access = self._access[principal_id]
+                access[resource_group] -= 1
+                if not access[resource_group]:
+                    del access[resource_group]
+                if not access:
+                    del self._access[principal_id]
+            for assignment_id in added:
+                principal_id, resource_group = self._assignments[assignment_id] = latest[assignment_id]
+                access = self._access.setdefault(principal_id, {})
+                access[resource_group] = access.get(resource_group, 0) + 1
+        if added or removed:
+            self.log.info(f"Project access index updated: {len(added)} role assignments added,"
+                          f" {len(removed)} removed.")
+        return self
+
+    def resource_groups(self, principal_ids):
+        """Return the (lower case) Resource Groups that any of `principal_ids` has a role on."""
+        with self._lock:
+            return {rg for principal_id in principal_ids for rg in self._access.get(principal_id, ())}
+
+    def filter(self, principal_ids, rg_names):
+        """Return those of `rg_names` that any of `principal_ids` has a role on."""
+        allowed = self.resource_groups(principal_ids)
+        if ALL_RESOURCE_GROUPS in allowed:
+            return list(rg_names)
+        return [rg for rg in rg_names if rg.lower() in allowed]
@@ -8,35 +8,83 @@ import re
 import tempfile
 import hashlib
 import asyncio
+import functools
 
-from traitlets import Unicode, Integer, default, Bool
+from traitlets import Unicode, Integer, Float, default, Bool, List, Dict
 from jupyterhub.spawner import Spawner
 from jupyterhub.crypto import decrypt
 
 from async_generator import async_generator, yield_
 
-from azure.identity import ClientSecretCredential
-from azure.common.credentials import ServicePrincipalCredentials
-from azure.mgmt.resource import ResourceManagementClient
-from azure.mgmt.compute import ComputeManagementClient
-
-from azureml.core import Workspace
-from azureml.core.authentication import ServicePrincipalAuthentication
-from azureml.core.compute import ComputeInstance
-from azureml.exceptions import ComputeTargetException, ProjectSystemException
-
-from . import redirector
+from . import clients, placement, redirector, sdk
+from .access import ProjectAccessIndex, list_role_assignments
+from .cache import TTLCache
+from .durations import TransitionDurations
+from .events import EventStream
+from .executor import AzureExecutor
+from .inflight import InflightOperations
+from .metrics import time_phase
+from .pipeline import Pipeline
+from .poller import ComputeStatusPoller, UNKNOWN_STATE
+from .scheduler import AzureScheduler, BACKGROUND, INTERACTIVE
+from .stalls import StallDetector
+from .warm_pool import WarmPoolManager
 
 URL_REGEX = re.compile(r'\bhttps://[^ ]*')
 CODE_REGEX = re.compile(r'\b[A-Z0-9]{9}\b')
+# Candidates for each size, in order of preference. Each family has its own quota, so a
+# later candidate is used when the subscription has no quota left for the earlier ones.
 VM_SIZES = {
-    "Small ($)": ["Standard_DS1_v2"],
-    "Medium ($$)": ["Standard_DS3_v2"],
-    "Large ($$$)": ["Standard_DS5_v2"],
+    "Small ($)": ["Standard_DS1_v2", "Standard_D1_v2"],
+    "Medium ($$)": ["Standard_DS3_v2", "Standard_D3_v2"],
+    "Large ($$$)": ["Standard_DS5_v2", "Standard_D5_v2"],
     "GPU ($$$)": ["Standard_NC6"]
 
 }
 
+
+def _list_vm_sizes(compute_mgmt_client, region):
+    """
+    Return the VM sizes offered to the subscription in `region`, as `{name: {"family": ...,
+    "vcpus": ...}}`. This pages through every SKU in the region, so it is slow: go through
+    `AMLSpawner.vm_size_cache` instead.
+    """
+    filter_string = f"location eq '{region}'"
+    skus = compute_mgmt_client.resource_skus.list(filter=filter_string)
+    vm_sizes = {}
+    for sku in skus:
+        if sku.resource_type != "virtualMachines":
+            continue
+        if any(str(r.type).endswith("Location") for r in sku.restrictions or ()):
+            # Not offered to this subscription in this region.
+            continue
+        capabilities = {c.name: c.value for c in sku.capabilities or ()}
+        vm_sizes[sku.name] = {"family": sku.family, "vcpus": int(capabilities.get("vCPUs", 0))}
+    return vm_sizes
+
+
+def _vm_sizes_from_json(value):
+    if not isinstance(value, dict):
+        raise TypeError("snapshot is from an older version, without VM families")
+    return value
+
+
+def _list_resource_group_names(res_mgmt_client):
+    """Return the names of all Resource Groups in the subscription."""
+    return tuple(rg.as_dict()["name"] for rg in res_mgmt_client.resource_groups.list())
+
+
+def prestart_hook(authenticator, handler, authentication):
+    """
+    An `Authenticator.post_auth_hook` that speculatively starts the user's last-used
+    compute instance as soon as they log in. See `AMLSpawner.prestart_enabled`.
+    """
+    user = handler.find_user(authentication["name"])
+    if user is not None and isinstance(user.spawner, AMLSpawner):
+        user.spawner.prestart()
+    return authentication
+
+
 class AMLSpawner(Spawner):
     """
     A JupyterHub spawner that creates AzureML resources. A user will be given an
@@ -49,12 +97,37 @@ class AMLSpawner(Spawner):
     _vm_transition_states = ["creating", "updating", "deleting"]
     _vm_stopped_states = ["stopping", "stopped"]
     _vm_bad_states = ["failed"]
+    # How long (in seconds) an instance we are waiting on may go missing from the listing, e.g.
+    # just after it was created, before we decide it has been deleted.
+    _vm_unknown_timeout = 60
     _events = None
     _last_progress = 50
+    _vm_size_cache = None
+    _resource_group_cache = None
+    _usage_cache = None
+    _project_access_cache = None
+    _azure_executor = None
+    _azure_scheduler = None
+    _workspace_cache = None
+    _warm_pool_manager = None
+    _stall_detector = None
+    _transition_durations = None
+    _prestarts = {}
+    _inflight = InflightOperations()
+    _operation = None
+    _state_keys = ["resource_group_name", "workspace_name", "vm_size", "compute_instance_name",
+                   "from_warm_pool", "redirect_path"]
 
     ip = Unicode('0.0.0.0', config=True,
                  help="The IP Address of the spawned JupyterLab instance.")
 
+    redirect_port = Integer(
+        9001, config=True,
+        help="""
+        Port of the redirect server in the hub, which sends users on to their compute instance.
+        One server, on this port, is shared by every user.
+        """)
+
     start_timeout = Integer(
         3600, config=True,
         help="""
@@ -64,6 +137,191 @@ class AMLSpawner(Spawner):
         start should return when the server process is started and its location is known.
         """)
 
+    vm_sku_cache_ttl = Integer(
+        24 * 3600, config=True,
+        help="""
+        Time (in seconds) for which the list of VM sizes offered in a region is trusted.
+        After this the cached list is still used, but is refreshed in the background.
+        """)
+
+    vm_sku_cache_path = Unicode(
+        '', config=True,
+        help="""
+        Path of a JSON snapshot of the VM sizes offered per region. If set, a restarted hub
+        reads the snapshot instead of listing the region's SKUs again.
+        """)
+
+    azure_executor_pool_size = Integer(
+        16, config=True,
+        help="""
+        Number of threads shared by all spawners for making blocking Azure SDK calls.
+        This bounds how many Azure calls the hub makes at once.
+        """)
+
+    azure_call_timeout = Integer(
+        300, config=True,
+        help="""
+        Timeout (in seconds) for a single Azure SDK call. 0 means no timeout.
+        """)
+
+    azure_read_rate_limit = Float(
+        10, config=True,
+        help="""
+        Average number of Azure read requests per second that all spawners may make together.
+        """)
+
+    azure_write_rate_limit = Float(
+        1, config=True,
+        help="""
+        Average number of Azure write requests (e.g. creating, starting or stopping compute
+        instances) per second that all spawners may make together.
+        """)
+
+    azure_rate_burst = Integer(
+        20, config=True,
+        help="""
+        Number of Azure read or write requests that may be made at once, above the average rates.
+        """)
+
+    azure_max_retries = Integer(
+        5, config=True,
+        help="""
+        Number of times a throttled Azure request is retried, with jittered exponential backoff,
+        before giving up.
+        """)
+
+    compute_status_interval = Integer(
+        5, config=True,
+        help="""
+        Interval (in seconds) at which the states of all compute instances in a workspace are
+        listed. States are shared by all spawners in the workspace, and reused for this long.
+        """)
+
+    compute_status_min_interval = Integer(
+        2, config=True,
+        help="""
+        Shortest interval (in seconds) between listings while waiting for a compute instance to
+        reach a state, used around the time it is expected to get there.
+        """)
+
+    compute_status_max_interval = Integer(
+        30, config=True,
+        help="""
+        Longest interval (in seconds) between listings while waiting for a compute instance to
+        reach a state, used while it is not expected to get there for a while.
+        """)
+
+    transition_durations_path = Unicode(
+        '', config=True,
+        help="""
+        Path of a JSON file in which to keep how long compute instances of each VM size took
+        to be created, started and stopped, so that the expected durations (and the ETAs shown
+        while spawning) survive a restart of the hub. If unset, they are only kept in memory.
+        """)
+
+    workspace_cache_ttl = Integer(
+        3600, config=True,
+        help="""
+        Time (in seconds) for which a looked-up AzureML workspace is reused by all spawners
+        before it is looked up again in the background.
+        """)
+
+    warm_pools = List(
+        Dict(), config=True,
+        help="""
+        Pools of compute instances to keep provisioned ahead of demand, one dict per pool. E.g.
+        `{"resource_group": "Pangeo-proj", "vm_size": "Standard_DS1_v2", "users": ["<object ID>", ...],
+        "size": 1, "max_size": 4, "running": False,
+        "schedule": [{"days": [0, 1, 2, 3, 4], "hours": [8, 18], "size": 3}]}`.
+        A spawn that would otherwise create a new compute instance takes one from the pool instead,
+        and the instance is deleted when the server stops.
+
+        AzureML fixes the user an instance is assigned to when it is created, and only that user
+        can use it. So pooled instances are created for the users (AAD object IDs) who are expected
+        to spawn, e.g. the members of a class, at most one each, and only handed out to them.
+        """)
+
+    warm_pool_refill_interval = Integer(
+        60, config=True,
+        help="""
+        Interval (in seconds) at which the warm pools are topped up to their target sizes.
+        """)
+
+    prestart_enabled = Bool(
+        False, config=True,
+        help="""
+        Start a returning user's most recently used compute instance in the background as soon
+        as they open the spawn form (or log in, with `prestart_hook`), so that it is already
+        starting by the time they submit the form.
+        """)
+
+    prestart_grace_period = Integer(
+        300, config=True,
+        help="""
+        Time (in seconds) after which a speculatively started compute instance that nobody has
+        spawned on is stopped again.
+        """)
+
+    resource_group_cache_ttl = Integer(
+        300, config=True,
+        help="""
+        Time (in seconds) for which the list of Resource Groups shown in the options form
+        is trusted. After this the cached list is still shown, but is refreshed in the background.
+        """)
+
+    stall_threshold = Float(
+        0, config=True,
+        help="""
+        Record each stall of the hub's event loop longer than this (in seconds), with the
+        spawner method and Azure call that caused it. The statistics are served by
+        `aml_jupyterhub.handlers.StallsAPIHandler`. 0 (the default) turns stall detection off.
+        """)
+
+    quota_aware_placement = Bool(
+        True, config=True,
+        help="""
+        Only offer VM sizes that the subscription has AzureML vCPU quota left for, falling back
+        to the next candidate size in `VM_SIZES` when one is full. Needs the service principal to
+        be able to read AzureML usages in the region.
+        """)
+
+    usage_cache_ttl = Integer(
+        300, config=True,
+        help="""
+        Time (in seconds) for which the AzureML vCPU usage and quota in the region is trusted.
+        It is also refreshed in the background whenever a compute instance is created or started.
+        """)
+
+    project_access_from_roles = Bool(
+        False, config=True,
+        help="""
+        Only offer each user the projects (Resource Groups) that they, or a group in their
+        `groups` token claim, have a role assignment on, instead of those with "Pangeo" in
+        their name. The role assignments in the subscription are indexed in the background,
+        so this needs the service principal to be able to read them.
+        """)
+
+    project_access_roles = List(
+        Unicode(), config=True,
+        help="""
+        GUIDs of the role definitions that give access to a project with `project_access_from_roles`,
+        e.g. `["b24988ac-6180-42a0-ab88-20f7382dd24c"]` for Contributor. By default any role does.
+        """)
+
+    project_access_ttl = Integer(
+        600, config=True,
+        help="""
+        Time (in seconds) for which the index of role assignments is trusted. After this it is
+        still used, but is brought up to date in the background.
+        """)
+
+    bulk_concurrency = Integer(
+        50, config=True,
+        help="""
+        Default number of servers or compute instances that a bulk operation (see
+        `aml_jupyterhub.handlers.BulkAPIHandler`) acts on at once.
+        """)
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
@@ -71,6 +329,14 @@ class AMLSpawner(Spawner):
         self.compute_instance = None
         self._application_urls = None
         self.redirect_server = None
+        self.redirect_path = None
+        self.from_warm_pool = False
+        self.resource_group_name = None
+        self.workspace_name = None
+        self.vm_size = None
+        self.compute_instance_name = None
+        self._principal_ids = None
+        self._pipeline = None
 
         self.subscription_id = os.environ['SUBSCRIPTION_ID']
         self.location = os.environ['LOCATION']
@@ -79,33 +345,75 @@ class AMLSpawner(Spawner):
         self.client_id = os.environ["AAD_CLIENT_ID"]
         self.client_secret = os.environ["AAD_CLIENT_SECRET"]
 
-        self.cred = ClientSecretCredential(
-            tenant_id=self.tenant_id,
-            client_id=self.client_id,
-            client_secret=self.client_secret)
-        self.sp_cred = ServicePrincipalCredentials(
-            tenant=self.tenant_id,
-            client_id=self.client_id,
-            secret=self.client_secret)
-        self.sp_auth = ServicePrincipalAuthentication(
-            tenant_id=self.tenant_id,
-            service_principal_id=self.client_id,
-            service_principal_password=self.client_secret)
-        self.res_mgmt_client = ResourceManagementClient(
-            self.sp_cred,
-            self.subscription_id)
-        self.compute_mgmt_client = ComputeManagementClient(
-            self.cred,
-            self.subscription_id)
-        self.available_vm_sizes = self._available_vm_sizes()
-
+        # Import the Azure SDKs in the background, now that they are going to be needed.
+        sdk.preload()
+        # Credentials and management clients are shared by every spawner in the hub.
+        self.azure = clients.get_clients(self.tenant_id, self.client_id,
+                                         self.client_secret, self.subscription_id)
+        self._start_stall_detector()
+        # Start loading what the options form needs now, without waiting for it.
+        self.vm_size_cache.peek(self.location)
+        self.resource_group_cache.peek(self.subscription_id)
+        if self.quota_aware_placement:
+            self.usage_cache.peek(self.location)
+        if self.project_access_from_roles:
+            self.project_access_cache.peek(self.subscription_id)
+
+    @property
+    def cred(self):
+        return self.azure.cred
+
+    @property
+    def sp_cred(self):
+        return self.azure.sp_cred
+
+    @property
+    def sp_auth(self):
+        return self.azure.sp_auth
+
+    @property
+    def res_mgmt_client(self):
+        return self.azure.res_mgmt_client
+
+    @property
+    def compute_mgmt_client(self):
+        return self.azure.compute_mgmt_client
 
     def _filter_rg_names(self, rg_list):
         """
-        We will want to only display Resource Groups that the user has permissions on.
-        For now, just do simple filter on name.
+        Only display Resource Groups that the user has a role on, from the hub-wide index of
+        role assignments. Unless that is enabled, just do simple filter on name.
         """
-        return [rg for rg in rg_list if "Pangeo" in rg]
+        if not self.project_access_from_roles:
+            return [rg for rg in rg_list if "Pangeo" in rg]
+        index = self.project_access_cache.peek(self.subscription_id)
+        if index is None or self._principal_ids is None:
+            return []
+        return index.filter(self._principal_ids, rg_list)
+
+    @staticmethod
+    def _principal_ids_from(auth_state):
+        """The object IDs of the user, and of the groups they are in, from their token."""
+        user = auth_state["user"]
+        return {user["oid"], *user.get("groups", ())}
+
+    def _check_project_access(self):
+        if self.project_access_from_roles and not self._filter_rg_names([self.resource_group_name]):
+            raise ValueError(f"You don't have access to the project {self.resource_group_name}.")
+
+    @property
+    def project_access_cache(self):
+        """The hub-wide index of who has a role on each Resource Group, shared by all spawners."""
+        if AMLSpawner._project_access_cache is None:
+            azure = self.azure
+            scheduler = self.azure_scheduler
+            index = ProjectAccessIndex(self.subscription_id, roles=self.project_access_roles, log=self.log)
+            AMLSpawner._project_access_cache = TTLCache(
+                lambda subscription_id: index.update(scheduler.call_threadsafe(
+                    list_role_assignments, azure.auth_mgmt_client, priority=BACKGROUND)),
+                ttl=self.project_access_ttl,
+                log=self.log)
+        return AMLSpawner._project_access_cache
 
     def _sanitize_and_truncate_username(self, username):
         """
@@ -139,37 +447,215 @@ class AMLSpawner(Spawner):
         return "ci-"+truncated_username+"-"+"v"+output_hash.hexdigest()[:7]
 
 
+    @property
+    def azure_executor(self):
+        """The hub-wide executor for blocking Azure SDK calls, shared by all spawners."""
+        if AMLSpawner._azure_executor is None:
+            AMLSpawner._azure_executor = AzureExecutor(
+                max_workers=self.azure_executor_pool_size,
+                timeout=self.azure_call_timeout,
+                log=self.log)
+        return AMLSpawner._azure_executor
+
+    @property
+    def azure_scheduler(self):
+        """The hub-wide scheduler through which all Azure calls are rate limited and retried."""
+        if AMLSpawner._azure_scheduler is None:
+            AMLSpawner._azure_scheduler = AzureScheduler(
+                self.azure_executor,
+                read_rate=self.azure_read_rate_limit,
+                write_rate=self.azure_write_rate_limit,
+                burst=self.azure_rate_burst,
+                max_retries=self.azure_max_retries,
+                log=self.log)
+        return AMLSpawner._azure_scheduler
+
+    async def _azure_call(self, func, *args, write=False, priority=INTERACTIVE, timeout=None, **kwargs):
+        """Make a blocking Azure SDK call through the shared scheduler, off the event loop."""
+        return await self.azure_scheduler.call(func, *args, write=write, priority=priority,
+                                               timeout=timeout, **kwargs)
+
+    @property
+    def vm_size_cache(self):
+        """The hub-wide cache of VM sizes offered per region, shared by all spawners."""
+        if AMLSpawner._vm_size_cache is None:
+            azure = self.azure
+            scheduler = self.azure_scheduler
+            AMLSpawner._vm_size_cache = TTLCache(
+                lambda region: scheduler.call_threadsafe(
+                    _list_vm_sizes, azure.compute_mgmt_client, region, priority=BACKGROUND),
+                ttl=self.vm_sku_cache_ttl,
+                snapshot_path=self.vm_sku_cache_path or None,
+                from_json=_vm_sizes_from_json,
+                log=self.log)
+        return AMLSpawner._vm_size_cache
+
+    @property
+    def usage_cache(self):
+        """The hub-wide cache of AzureML vCPU usage and quota per region, shared by all spawners."""
+        if AMLSpawner._usage_cache is None:
+            azure = self.azure
+            scheduler = self.azure_scheduler
+            subscription_id = self.subscription_id
+            AMLSpawner._usage_cache = TTLCache(
+                lambda region: scheduler.call_threadsafe(
+                    placement.list_usages, azure.cred, subscription_id, region,
+                    priority=BACKGROUND),
+                ttl=self.usage_cache_ttl,
+                log=self.log)
+        return AMLSpawner._usage_cache
+
+    def _quota_usages(self):
+        """Return the usages in our region from the cache, or None if we don't know them (yet)."""
+        if not self.quota_aware_placement:
+            return None
+        return self.usage_cache.peek(self.location)
+
+    def _quota_changed(self):
+        """We have just used some quota, so look at the usages again."""
+        if self.quota_aware_placement:
+            self.usage_cache.refresh_in_background(self.location)
+
+    @property
+    def resource_group_cache(self):
+        """The hub-wide cache of Resource Group names per subscription, shared by all spawners."""
+        if AMLSpawner._resource_group_cache is None:
+            azure = self.azure
+            scheduler = self.azure_scheduler
+            AMLSpawner._resource_group_cache = TTLCache(
+                lambda subscription_id: scheduler.call_threadsafe(
+                    _list_resource_group_names, azure.res_mgmt_client, priority=BACKGROUND),
+                ttl=self.resource_group_cache_ttl,
+                log=self.log)
+        return AMLSpawner._resource_group_cache
+
+    @property
+    def workspace_cache(self):
+        """
+        The hub-wide cache of AzureML workspaces, keyed by subscription, resource group and
+        workspace name. Concurrent lookups of the same workspace share one `Workspace.create`.
+        """
+        if AMLSpawner._workspace_cache is None:
+            azure = self.azure
+            scheduler = self.azure_scheduler
+            location = self.location
+            AMLSpawner._workspace_cache = TTLCache(
+                lambda key: scheduler.call_threadsafe(sdk.Workspace.create,
+                                                      name=key[2],
+                                                      subscription_id=key[0],
+                                                      resource_group=key[1],
+                                                      create_resource_group=False,
+                                                      location=location,
+                                                      sku='enterprise',
+                                                      show_output=False,
+                                                      exist_ok=True,
+                                                      auth=azure.sp_auth),
+                ttl=self.workspace_cache_ttl,
+                log=self.log)
+        return AMLSpawner._workspace_cache
+
+    @property
+    def transition_durations(self):
+        """The hub-wide record of how long compute instance state transitions take."""
+        if AMLSpawner._transition_durations is None:
+            AMLSpawner._transition_durations = TransitionDurations(
+                path=self.transition_durations_path or None,
+                log=self.log)
+        return AMLSpawner._transition_durations
+
+    @property
+    def warm_pool_manager(self):
+        """The hub-wide manager of the configured warm pools, or None if there are none."""
+        if AMLSpawner._warm_pool_manager is None and self.warm_pools:
+            scheduler = self.azure_scheduler
+            interval = self.compute_status_interval
+            log = self.log
+            AMLSpawner._warm_pool_manager = WarmPoolManager(
+                self.warm_pools,
+                self.subscription_id,
+                self.tenant_id,
+                get_workspace=self.workspace_cache.aget,
+                poller_for=lambda workspace: ComputeStatusPoller.for_workspace(
+                    workspace, scheduler.call, interval=interval, log=log),
+                run=scheduler.call,
+                interval=self.warm_pool_refill_interval,
+                log=self.log)
+        return AMLSpawner._warm_pool_manager
+
+    def _start_stall_detector(self):
+        """Start the hub-wide stall detector, if it is enabled and not already running."""
+        if AMLSpawner._stall_detector is None and self.stall_threshold > 0:
+            AMLSpawner._stall_detector = StallDetector(asyncio.get_event_loop(),
+                                                       threshold=self.stall_threshold,
+                                                       log=self.log)
+            AMLSpawner._stall_detector.start()
+
+    def _start_warm_pools(self):
+        if self.warm_pool_manager is not None:
+            self.warm_pool_manager.start()
+
+    def _workspace_key(self):
+        return (self.subscription_id, self.resource_group_name, self.workspace_name)
+
     def _vm_sizes_per_region(self, region):
         """
-        Return a list of VM sizes for the selected region.
+        Return the VM sizes for the selected region, with their families and vCPUs.
+        On the event loop, `await self.vm_size_cache.aget(region)` first, so this doesn't block.
         """
-        filter_string = f"location eq '{region}'"
-        skus = self.compute_mgmt_client.resource_skus.list(filter=filter_string)
-        vm_sizes = [sku.name for sku in skus if sku.resource_type=="virtualMachines"]
-        return vm_sizes
+        return self.vm_size_cache.get(region)
 
+    @property
+    def available_vm_sizes(self):
+        return self._available_vm_sizes()
 
     def _available_vm_sizes(self):
         """
         We have a global dict VM_SIZES containing a list of potential "Small", "Medium",...
-        VM sizes.  Get the list of available VM sizes from the Azure SDK, and see
+        VM sizes.  Get the VM sizes offered in the region from the (cached) Azure SDK, and
+        pick the first of each that we have quota left for.
         """
-        available_vm_sizes = {}
+        return {size: vm for size, (vm, full) in self._vm_size_choices().items() if not full}
+
+    def _vm_size_choices(self):
+        """Return `{size: (vm_size, full)}` for each of VM_SIZES offered in the region."""
+        choices = {}
         vms_for_region = self._vm_sizes_per_region(self.location)
+        usages = self._quota_usages()
         for human_readable_size, vm_list in VM_SIZES.items():
-            for vm in vm_list:
-                if vm in vms_for_region:
-                    available_vm_sizes[human_readable_size] = vm
-                    break
-        return available_vm_sizes
+            vm, full = placement.choose_vm_size(vm_list, vms_for_region, usages)
+            if vm is not None:
+                choices[human_readable_size] = (vm, full)
+        return choices
 
 
     def _options_form_default(self):
-        rg_names = [rg.as_dict()["name"] for rg in self.res_mgmt_client.resource_groups.list()]
+        # A callable form is rendered afresh on each page load, and may be async.
+        return lambda spawner: spawner._render_options_form()
+
+    async def _render_options_form(self):
+        """
+        Render the options form from the hub-wide caches. These are refreshed in the
+        background, so only the very first page load after the hub starts waits for Azure,
+        and even then without blocking the event loop.
+        """
+        self._start_warm_pools()
+        self.prestart()
+        rg_names = await self.resource_group_cache.aget(self.subscription_id)
+        await self.vm_size_cache.aget(self.location)
+        if self.project_access_from_roles:
+            self._principal_ids = self._principal_ids_from(await decrypt(self.user.encrypted_auth_state))
+            await self.project_access_cache.aget(self.subscription_id)
+        if self.quota_aware_placement:
+            try:
+                await self.usage_cache.aget(self.location)
+            except Exception as e:
+                self.log.warning(f"Could not look up AzureML quota in {self.location}: {e}")
         filtered_rg_names = self._filter_rg_names(rg_names)
-        vm_sizes = self.available_vm_sizes.keys()
+        vm_sizes = self._vm_size_choices()
         project_opt = '\n'.join([f"<option value=\"{rg}\">{rg}</option>" for rg in filtered_rg_names])
-        vm_size_opt = '\n'.join([f"<option value=\"{vm}\">{vm}</option>" for vm in vm_sizes])
+        vm_size_opt = '\n'.join([f"<option value=\"{vm}\" disabled>{vm} - no quota left</option>" if full
+                                 else f"<option value=\"{vm}\">{vm}</option>"
+                                 for vm, (_, full) in vm_sizes.items()])
         return f"""
         <h2>Welcome {self.user.name}.</h2>
         <div class="form-group">
@@ -186,30 +672,52 @@ class AMLSpawner(Spawner):
         </div>
         """
 
-    def options_from_form(self, formdata):
+    async def options_from_form(self, formdata):
+        previous_compute_instance_name = self.compute_instance_name
         # Resource group name
         rg_selected = formdata.get('rg_select')[0]
         self.resource_group_name = rg_selected
         # Workspace name will be the same as resource group name (=="project name")
         self.workspace_name = rg_selected
+        self._check_project_access()
         # VM size - look up in a dict what "Small", "Medium" etc. are.
         size_selected = formdata.get('vm_select')[0]
-        self.vm_size = self.available_vm_sizes[size_selected]
+        # The form may be submitted before the VM sizes have been loaded, e.g. just after a restart.
+        await self.vm_size_cache.aget(self.location)
+        choices = self._vm_size_choices()
+        if size_selected not in choices:
+            raise ValueError(f"{size_selected} VMs are not offered in {self.location}. Please choose another size.")
+        vm_size, full = choices[size_selected]
+        if full:
+            # Fail now, rather than minutes into creating a compute instance.
+            raise ValueError(f"There is no quota left for {size_selected} VMs in {self.location}. "
+                             "Please choose another size, or try again later.")
+        self.vm_size = vm_size
         # CI name - workspace name + Small/Medium/Large
         self.compute_instance_name = self._construct_ci_name()
+        self.from_warm_pool = False
+        if previous_compute_instance_name != self.compute_instance_name:
+            # The user chose something else, so don't keep the last one running for them.
+            self._abandon_prestart(previous_compute_instance_name)
+        else:
+            self._keep_prestart()
 
 
     def _start_recording_events(self):
-        self._events = []
+        self._events = EventStream()
 
     def _stop_recording_events(self):
-        self._events = None
+        if self._events is not None:
+            self._events.close()
 
     def _add_event(self, msg, progress=None):
-        if self._events is not None:
+        if self._operation is not None:
+            # Pass our events on to anyone who joined the operation we are running.
+            self._operation.emit(msg, self._last_progress if progress is None else progress)
+        if self._events is not None and not self._events.closed:
             if progress is None:
                 progress = self._last_progress
-            self._events.append((msg, progress))
+            self._events.add(msg, progress)
             self.log.info(f"Event {msg}@{progress}%")
             self._last_progress = progress
 
@@ -237,119 +745,372 @@ class AMLSpawner(Spawner):
 
     def _applications(self):
         """Parse Application URLs from the compute instance into a more queryable format."""
-        applications = self.compute_instance.applications
+        # The poller's latest listing is more up to date than our own `compute_instance`.
+        compute_instance = (self.compute_status_poller.instance(self.compute_instance_name)
+                            or self.compute_instance)
+        applications = compute_instance.applications
         return {d["displayName"]: d["endpointUri"] for d in applications}
 
-    def _poll_compute_setup(self):
-        compute_instance_status = self.compute_instance.get_status()
-        state = compute_instance_status.state
-        errors = compute_instance_status.errors
-        return state, errors
+    @property
+    def compute_status_poller(self):
+        """The poller shared by all spawners using this spawner's workspace."""
+        return self._poller_for(self.workspace)
 
-    def _get_workspace(self):
+    def _poller_for(self, workspace):
+        return ComputeStatusPoller.for_workspace(workspace,
+                                                 self.azure_scheduler.call,
+                                                 interval=self.compute_status_interval,
+                                                 log=self.log)
+
+    async def _poll_compute_setup(self, max_age=None, priority=BACKGROUND):
+        """Return the state and errors of the compute instance, from the shared poller."""
+        return await self.compute_status_poller.status(self.compute_instance_name, max_age,
+                                                       priority=priority)
+
+    async def _get_workspace(self):
         self.log.info(f"Setting workspace {self.workspace_name}.")
         self._add_event(f"Setting workspace {self.workspace_name}", 1)
-        self.workspace = Workspace.create(name=self.workspace_name,
-                                            subscription_id=self.subscription_id,
-                                            resource_group=self.resource_group_name,
-                                            create_resource_group=False,
-                                            location=self.location,
-                                            sku='enterprise',
-                                            show_output=False,
-                                            exist_ok=True,
-                                            auth=self.sp_auth)
+        self.workspace = await self.workspace_cache.aget(self._workspace_key())
         self.log.info(f"Using workspace: {self.workspace_name}.")
         self._add_event(f"Using workspace: {self.workspace_name}.", 10)
 
 
-    def _set_up_compute_instance(self):
+    async def _set_up_compute_instance(self):
         """
         Set up an AML compute instance for the workspace. The compute instance is responsible
         for running the Python kernel and the optional JupyterLab instance for the workspace.
-        """
-        # Verify that cluster does not exist already.
-        try:
-            self.compute_instance = ComputeInstance(workspace=self.workspace,
-                                                    name=self.compute_instance_name)
 
+        Return the state the instance was in, or None if we have just created it.
+        """
+        await self._join_prestart()
+        # Verify that cluster does not exist already. The shared poller's listing tells us
+        # the instance's state too, so a stopped instance can be started straight away.
+        state, _ = await self._poll_compute_setup(max_age=0, priority=INTERACTIVE)
+        compute_instance = self.compute_status_poller.instance(self.compute_instance_name)
+        if compute_instance is not None:
+            self.compute_instance = compute_instance
             self.log.info(f"Compute instance {self.compute_instance_name} already exists.")
             self._add_event(f"Compute instance {self.compute_instance_name} already exists", 20)
-        except ComputeTargetException:
-            self._add_event(f"Creating compute instance {self.compute_instance_name}", 15)
-            # Create CI provisioned on behalf of another user - Enabling SSH is not allowed in this case.
-            self.log.info(f"Creating VM of size {self.vm_size}")
-            instance_config = ComputeInstance.provisioning_configuration(vm_size=self.vm_size,
-                                                                         assigned_user_object_id=self.environment['USER_OID'],
-                                                                         assigned_user_tenant_id=self.tenant_id)
-            self.compute_instance = ComputeInstance.create(self.workspace,
-                                                         self.compute_instance_name,
-                                                         instance_config)
-            self.log.info(f"Created compute instance {self.compute_instance_name}.")
-            self._add_event(f"Created compute instance {self.compute_instance_name}.", 20)
-
-    def _start_compute_instance(self):
+            return state
+        if self._pipeline is not None:
+            # Only creating (or claiming) an instance needs the user's object ID.
+            await self._pipeline.result("auth_state")
+        if await self._claim_from_warm_pool():
+            state, _ = await self._poll_compute_setup(priority=INTERACTIVE)
+            return state
+        self._add_event(f"Creating compute instance {self.compute_instance_name}", 15)
+        # Create CI provisioned on behalf of another user - Enabling SSH is not allowed in this case.
+        self.log.info(f"Creating VM of size {self.vm_size}")
+        instance_config = sdk.ComputeInstance.provisioning_configuration(vm_size=self.vm_size,
+                                                                     assigned_user_object_id=self.environment['USER_OID'],
+                                                                     assigned_user_tenant_id=self.tenant_id)
+        self.compute_instance = await self._azure_call(sdk.ComputeInstance.create,
+                                                       self.workspace,
+                                                       self.compute_instance_name,
+                                                       instance_config,
+                                                       write=True)
+        self._quota_changed()
+        self.log.info(f"Created compute instance {self.compute_instance_name}.")
+        self._add_event(f"Created compute instance {self.compute_instance_name}.", 20)
+        return None
+
+    async def _claim_from_warm_pool(self):
+        """Use a pre-provisioned compute instance instead of creating one, if there is one ready."""
+        if self.warm_pool_manager is None:
+            return False
+        name = self.warm_pool_manager.claim(self._workspace_key(), self.vm_size, self.environment['USER_OID'])
+        if name is None:
+            return False
+        self.compute_instance_name = name
+        self.from_warm_pool = True
+        self.compute_instance = await self._azure_call(sdk.ComputeInstance,
+                                                       workspace=self.workspace,
+                                                       name=name)
+        self.log.info(f"Claimed compute instance {name} from the warm pool.")
+        self._add_event(f"Using pre-provisioned compute instance {name}.", 20)
+        return True
+
+    def prestart(self):
+        """
+        Speculatively start the compute instance this server last used, in the background.
+        `start()` then joins the start request that is already under way. If nobody spawns on
+        the instance within `prestart_grace_period`, it is stopped again.
+        """
+        name = self.compute_instance_name
+        if (not self.prestart_enabled or name is None or self.from_warm_pool
+                or self.active or name in AMLSpawner._prestarts):
+            return
+        self.log.info(f"Speculatively starting compute instance {name}.")
+        task = asyncio.ensure_future(self._prestart_compute_instance(self._workspace_key(), name))
+        timer = asyncio.get_event_loop().call_later(self.prestart_grace_period,
+                                                     self._abandon_prestart, name)
+        AMLSpawner._prestarts[name] = (self._workspace_key(), task, timer)
+
+    async def _prestart_compute_instance(self, workspace_key, name):
+        """Start the named instance if it is stopped. Return whether we started it."""
+        workspace = await self.workspace_cache.aget(workspace_key)
+        poller = self._poller_for(workspace)
+        state, _ = await poller.status(name, max_age=0)
+        if state.lower() != "stopped":
+            return False
+        await self._azure_call(poller.instance(name).start, write=True, priority=BACKGROUND)
+        return True
+
+    async def _join_prestart(self):
+        """If our compute instance is being speculatively started, wait for the start request."""
+        prestart = AMLSpawner._prestarts.pop(self.compute_instance_name, None)
+        if prestart is None:
+            return
+        _, task, timer = prestart
+        timer.cancel()
+        try:
+            if await task:
+                self._add_event("Compute instance was already starting.", 25)
+        except Exception as e:
+            self.log.warning(f"Speculative start of {self.compute_instance_name} failed: {e}")
+
+    def _abandon_prestart(self, name):
+        """Stop a speculatively started instance that nobody spawned on."""
+        prestart = AMLSpawner._prestarts.pop(name, None)
+        if prestart is not None:
+            workspace_key, task, timer = prestart
+            timer.cancel()
+            # As an operation on the instance, so a start that comes along meanwhile waits for it.
+            asyncio.ensure_future(AMLSpawner._inflight.run(
+                name, "stop", functools.partial(self._stop_prestarted, workspace_key, name, task),
+                lambda msg, progress: None))
+
+    async def _stop_prestarted(self, workspace_key, name, task, operation):
+        try:
+            # Let the start request finish, even if it's no longer wanted, so we can undo it.
+            if not await task:
+                return
+            self.log.info(f"Stopping speculatively started compute instance {name}.")
+            workspace = await self.workspace_cache.aget(workspace_key)
+            poller = self._poller_for(workspace)
+            await poller.status(name, max_age=0)
+            await self._azure_call(poller.instance(name).stop, write=True, priority=BACKGROUND)
+        except Exception as e:
+            self.log.warning(f"Could not stop speculatively started compute instance {name}: {e}")
+
+    def _keep_prestart(self):
+        """The user has chosen the instance being speculatively started, so don't stop it."""
+        prestart = AMLSpawner._prestarts.get(self.compute_instance_name)
+        if prestart is not None:
+            _, _, timer = prestart
+            timer.cancel()
+
+    async def _start_compute_instance(self, state):
+        """
+        Start the compute instance if `state`, from `_set_up_compute_instance`, is stopped,
+        or stopping, in which case wait for it to stop first.
+        """
         stopped_state = "stopped"
-        state, _ = self._poll_compute_setup()
+        if state is None:
+            return
         self.log.info(f"Compute instance state is {state}.")
         self._add_event(f"Compute instance in {state} state.", 20)
 
+        if state.lower() == "stopping":
+            self._add_event("Waiting for the compute instance to stop before starting it again.", 20)
+            await self._wait_for_target_state(stopped_state, progress_between=(20, 25))
+            state = stopped_state
+
         if state.lower() == stopped_state:
             try:
                 self.log.info(f"Starting the compute instance.")
                 self._add_event("Starting the compute instance. This may take a short while...", 25)
-                self.compute_instance.start()
-            except ComputeTargetException as e:
+                await self._azure_call(self.compute_instance.start, write=True)
+                self._quota_changed()
+            except sdk.ComputeTargetException as e:
                 self.log.warning(f"Could not start compute resource:\n{e.message}.")
 
-    def _stop_compute_instance(self):
+    async def _stop_compute_instance(self):
+        """Stop the compute instance (or delete it, if pooled). Return whether it is now stopping."""
+        if self.compute_instance is None:
+            return False
+        if self.from_warm_pool:
+            self.log.info(f"Deleting compute instance {self.compute_instance_name} from the warm pool.")
+            if self.warm_pool_manager is not None:
+                await self.warm_pool_manager.release(self.compute_instance_name)
+            else:
+                # The pools have since been removed from the config.
+                await self._azure_call(self.compute_instance.delete, write=True)
+            return False
         try:
             self.log.info(f"Stopping the compute instance.")
-            self.compute_instance.stop()
+            await self._azure_call(self.compute_instance.stop, write=True)
+            self._quota_changed()
+            return True
 
-        except ComputeTargetException as e:
+        except sdk.ComputeTargetException as e:
+            # E.g. it is still being created, or has been deleted.
             self.log.warning(e.message)
+            return False
 
-    async def _wait_for_target_state(self, target_state, progress_between=(30, 70), progress_in_seconds=240):
+    async def _wait_for_target_state(self, target_state, progress_between=(30, 70), progress_in_seconds=240,
+                                     since=None):
         """ Wait for the compute instance to be in the target state.
 
-        emit events reporting progress starting at `progress_between[0]` to `progress_between[1]` over `progress_in_seconds` seconds.
-        This is to give the use watching the progress bar the illusion of progress even if we don't really know how far we have progressed.
+        Time is measured from `since` (default now), e.g. when the request that set the instance
+        on its way to `target_state` was sent.
+
+        emit events reporting progress starting at `progress_between[0]` to `progress_between[1]`.
+        If we have seen this VM size make the same transition before, progress follows the expected
+        duration, with an ETA, and we poll less often until the instance is nearly due to get there.
+        Otherwise progress is spread over `progress_in_seconds` seconds, to give the user watching
+        the progress bar the illusion of progress even if we don't really know how far we have progressed.
         """
-        started_at = datetime.datetime.now()
-        while True:
-            state, _ = self._poll_compute_setup()
-            time_taken = datetime.datetime.now() - started_at
-            min_progress, max_progress = progress_between
-            progress = (min_progress + (max_progress - min_progress) * (time_taken.total_seconds()/progress_in_seconds))//1
-            progress = max_progress if progress > max_progress else progress
-            if state.lower() == target_state:
-                self.log.info(f"Compute in target state {target_state}.")
-                self._add_event(f"Compute in target state '{target_state}'.", max_progress)
-                break
-            elif state.lower() in self._vm_bad_states:
-                self._add_event(f"Compute instance in failed state: {state!r}.", min_progress)
-                raise ComputeTargetException(f"Compute instance in failed state: {state!r}.")
-            else:
-                self._add_event(
-                    f"Compute in state '{state.lower()}' after {time_taken.total_seconds():.0f} seconds."
-                    + f"Aiming for target state '{target_state}', this may take a short while", progress)
-            await asyncio.sleep(5)
+        started_at = since or datetime.datetime.now()
+        updates = self.compute_status_poller.subscribe(self.compute_instance_name)
+        try:
+            state, _ = await self._poll_compute_setup(max_age=0)
+            initial_state = state
+            expected = self.transition_durations.expected(self.vm_size, initial_state, target_state)
+            unknown_since = None
+            while True:
+                time_taken = datetime.datetime.now() - started_at
+                if state != UNKNOWN_STATE:
+                    unknown_since = None
+                elif unknown_since is None:
+                    unknown_since = time.monotonic()
+                min_progress, max_progress = progress_between
+                progress = (min_progress + (max_progress - min_progress) * (time_taken.total_seconds()/(expected or progress_in_seconds)))//1
+                progress = max_progress if progress > max_progress else progress
+                if state.lower() == target_state:
+                    self.log.info(f"Compute in target state {target_state}.")
+                    self._add_event(f"Compute in target state '{target_state}'.", max_progress)
+                    if initial_state.lower() != target_state:
+                        self.transition_durations.record(self.vm_size, initial_state, target_state,
+                                                         time_taken.total_seconds())
+                    break
+                elif state.lower() in self._vm_bad_states:
+                    self._add_event(f"Compute instance in failed state: {state!r}.", min_progress)
+                    raise sdk.ComputeTargetException(f"Compute instance in failed state: {state!r}.")
+                elif unknown_since is not None and time.monotonic() - unknown_since > self._vm_unknown_timeout:
+                    self._add_event(f"Compute instance {self.compute_instance_name} can no longer be found.", min_progress)
+                    raise sdk.ComputeTargetException(
+                        f"Compute instance {self.compute_instance_name} can no longer be found.")
+                else:
+                    self._add_event(
+                        f"Compute in state '{state.lower()}' after {time_taken.total_seconds():.0f} seconds."
+                        + f"Aiming for target state '{target_state}', "
+                        + self._eta_message(expected, time_taken.total_seconds()), progress)
+                    self.compute_status_poller.poll_after(
+                        updates, self._next_poll_delay(expected, time_taken.total_seconds()))
+                try:
+                    state, _ = await asyncio.wait_for(updates.get(), timeout=5)
+                except asyncio.TimeoutError:
+                    # No change of state yet, but keep the progress bar moving.
+                    pass
+        finally:
+            self.compute_status_poller.unsubscribe(self.compute_instance_name, updates)
+
+    @staticmethod
+    def _eta_message(expected, elapsed):
+        if expected is None:
+            return "this may take a short while"
+        if expected > elapsed:
+            return f"expected in about {expected - elapsed:.0f} seconds"
+        return "this is taking longer than usual"
+
+    def _next_poll_delay(self, expected, elapsed):
+        """
+        Poll least often long before we expect the transition to finish, and most often near it.
+        Once it is overdue it could finish at any moment, so only back off gently from there.
+        """
+        if expected is None:
+            return self.compute_status_interval
+        if elapsed >= expected:
+            return min(self.compute_status_max_interval,
+                       self.compute_status_min_interval + (elapsed - expected) / 10)
+        return min(self.compute_status_max_interval,
+                   max(self.compute_status_min_interval, (expected - elapsed) / 2))
+
+    def _redirect_path(self):
+        """The URL prefix the proxy routes to us for this server, e.g. `/user/alice/`."""
+        return self.server.base_url
+
+    async def _start_redirect_listener(self):
+        """Make sure the hub's shared redirect server is listening."""
+        self.redirect_server = redirector.RedirectServer.for_address(self.ip, self.redirect_port)
+        await self.redirect_server.start()
+
+    async def _start_redirect(self, url):
+        """Route this server's URL prefix to `url` on the hub's shared redirect server."""
+        if self.redirect_server is None:
+            await self._start_redirect_listener()
+        self.redirect_path = self._redirect_path()
+        self.redirect_server.add_route(self.redirect_path, url)
+        return self.redirect_server.route
 
     def _stop_redirect(self):
-        if self.redirect_server:
-            self.log.info(f"Stopping the redirect server route: {self.redirect_server.route}.")
-            self.redirect_server.stop()
-            self.redirect_server = None
+        # A start that failed or was cancelled may have started the listener, but added no route.
+        if self.redirect_server and self.redirect_path:
+            self.log.info(f"Removing the redirect server route: {self.redirect_path}.")
+            self.redirect_server.remove_route(self.redirect_path)
+        self.redirect_server = None
+        self.redirect_path = None
+
+    def _phase(self, operation, phase):
+        """Time `phase` of `operation` ("start" or "stop") for the `/hub/metrics` histogram."""
+        return time_phase(operation, phase, self.vm_size, self.workspace_name)
+
+    async def _run_compute_operation(self, kind, factory):
+        """
+        Run `factory(operation)` as the `kind` operation on our compute instance, or join the
+        same operation if another spawner (or an earlier request) already has it under way.
+        """
+        operation = AMLSpawner._inflight.get(self.compute_instance_name)
+        if operation is not None and operation.kind == kind:
+            self.log.info(f"Joining the {kind} of {self.compute_instance_name} already under way.")
+        return await AMLSpawner._inflight.run(self.compute_instance_name, kind, factory, self._add_event,
+                                              owner=self, wait_timeout=self.start_timeout)
+
+    async def _start_compute_operation(self, operation):
+        """Create or start the compute instance, and wait for it to be running."""
+        self._operation = operation
+        try:
+            with self._phase("start", "compute_setup"):
+                state = await self._set_up_compute_instance()
+            # Count the time taken to start from when we asked, not from when Azure answered.
+            requested_at = datetime.datetime.now() if state is not None else None
+            with self._phase("start", "compute_start"):
+                await self._start_compute_instance(state)  # Ensure existing but stopped resources are running.
+            target_state = "running"
+            with self._phase("start", "wait_for_running"):
+                await self._wait_for_target_state(target_state, since=requested_at)
+            return self.compute_instance_name, self.compute_instance, self.from_warm_pool
+        finally:
+            self._operation = None
+
+    async def _stop_compute_operation(self, now, operation):
+        """Stop the compute instance, and unless `now`, wait for it to be stopped."""
+        self._operation = operation
+        try:
+            with self._phase("stop", "compute_stop"):
+                stopping = await self._stop_compute_instance()
+            if not now and stopping:
+                target_state = "stopped"
+                with self._phase("stop", "wait_for_stopped"):
+                    await self._wait_for_target_state(target_state)
+        finally:
+            self._operation = None
 
     async def _set_up_resources(self):
-        """Both of these methods are blocking, so try and async them as a pair."""
-        self._get_workspace()
-        self._set_up_compute_instance()
-        self._start_compute_instance()  # Ensure existing but stopped resources are running.
-
-    def _tear_down_resources(self):
-        """This method blocks, so try and async it and pass back to a checker."""
-        self._stop_compute_instance()
+        """Each step makes its Azure calls through the shared scheduler, so the event loop is never blocked."""
+        try:
+            result = await self._run_compute_operation("start", self._start_compute_operation)
+        except Exception:
+            # The cached workspace may be the problem, so look it up afresh next time.
+            self.workspace_cache.invalidate(self._workspace_key())
+            raise
+        # If we joined someone else's start, pick up the compute instance they set up.
+        self.compute_instance_name, self.compute_instance, self.from_warm_pool = result
+
+    async def _tear_down_resources(self, now=False):
+        if self.compute_instance_name is not None:
+            await self._run_compute_operation("stop", functools.partial(self._stop_compute_operation, now))
         self._stop_redirect()
 
     def get_url(self):
@@ -359,56 +1120,91 @@ class AMLSpawner(Spawner):
 
     @ async_generator
     async def progress(self):
-        while self._events is not None:
-            if len(self._events) > 0:
-                msg, progress = self._events.pop(0)
+        """Yield each progress event as soon as it is added, until the spawn has finished."""
+        events = self._events
+        if events is None:
+            return
+        seen = 0
+        while True:
+            await events.wait(seen)
+            while seen < len(events.events):
+                msg, progress = events.events[seen]
+                seen += 1
                 await yield_({
                     'progress': progress,
                     'message':  msg
                 })
-            await asyncio.sleep(1)
+            if events.closed:
+                break
+
+    async def _load_auth_state(self):
+        auth_state = await decrypt(self.user.encrypted_auth_state)
+        self.environment['USER_OID'] = auth_state["user"]["oid"]
+        if self.project_access_from_roles:
+            # Also check spawns made through the API, without the form.
+            self._principal_ids = self._principal_ids_from(auth_state)
+            await self.project_access_cache.aget(self.subscription_id)
+            self._check_project_access()
+
+    async def _route_to_compute_instance(self):
+        # The URLs come with the listing that found the instance running, so this makes no Azure calls.
+        self.application_urls = None
+        url = self.application_urls["Jupyter Lab"]
+        self._add_event(f"Creating route to compute instance.", 91)
+        route = await self._start_redirect(url)
+        self._add_event(f"Route to compute instance created.", 95)
+        return route
+
+    def _spawn_pipeline(self):
+        """
+        The steps of a spawn, and the steps each must wait for. The compute instance is started
+        as soon as the workspace is known, while the user's auth state is decrypted and the
+        redirect server starts listening; only creating an instance (or checking project access)
+        has to wait for the auth state.
+        """
+        pipeline = Pipeline(log=self.log)
+
+        def add_timed(name, func, needs=()):
+            async def run():
+                with self._phase("start", name):
+                    return await func()
+            pipeline.add(name, run, needs)
+
+        add_timed("auth_state", self._load_auth_state)
+        add_timed("workspace", self._get_workspace)
+        add_timed("redirect_listener", self._start_redirect_listener)
+        # The compute steps time their own phases.
+        pipeline.add("compute", self._set_up_resources,
+                     needs=["workspace", "auth_state"] if self.project_access_from_roles else ["workspace"])
+        add_timed("redirect", self._route_to_compute_instance, needs=["compute", "redirect_listener"])
+        return pipeline
 
     async def start(self):
         """Start (spawn) AzureML resouces."""
         try:
             self._start_recording_events()
             self._add_event("Initializing...", 0)
+            self._start_warm_pools()
 
-            auth_state = await decrypt(self.user.encrypted_auth_state)
-            self.environment['USER_OID'] = auth_state["user"]["oid"]
-
-            await self._set_up_resources()
-
-            target_state = "running"
-            await self._wait_for_target_state(target_state)
-
-            url = self.application_urls["Jupyter Lab"]
-            route = redirector.RedirectServer.get_existing_redirect(url)
-            if route:
-                self._add_event(f"Existing route to compute instance found.", 95)
-            else:
-                self._add_event(f"Creating route to compute instance.", 91)
-                self.redirect_server = redirector.RedirectServer(url)
-                self.redirect_server.start()
-                await asyncio.sleep(1)
-                route = self.redirect_server.route
-                self._add_event(f"Route to compute instance created.", 95)
+            self._pipeline = self._spawn_pipeline()
+            with self._phase("start", "total"):
+                results = await self._pipeline.run()
+            critical_path = self._pipeline.describe_critical_path()
+            self.log.info(f"Started {self.compute_instance_name}, critical path: {critical_path}.")
 
-            self._add_event(f"Set up complete. Prepare for redirect...", 100)
+            self._add_event(f"Set up complete ({critical_path}). Prepare for redirect...", 100)
 
-            return route
+            return results["redirect"]
         finally:
+            self._pipeline = None
             self._stop_recording_events()
 
     async def stop(self, now=False):
         """Stop and terminate all spawned AzureML resources."""
-        self._tear_down_resources()
-
-        self._stop_redirect()
-
-        if not now:
-            target_state = "stopped"
-            await self._wait_for_target_state(target_state)
+        with self._phase("stop", "total"):
+            if self.compute_instance_name is not None:
+                await self._reattach()
+            await self._tear_down_resources(now)
 
     async def poll(self):
         """
@@ -423,9 +1219,12 @@ class AMLSpawner(Spawner):
               * 3: Compute instance stopped
 
         """
+        self._start_warm_pools()
         result = None
+        if self.compute_instance is None and self.compute_instance_name is not None:
+            await self._reattach()
         if self.compute_instance is not None:
-            status, errors = self._poll_compute_setup()
+            status, errors = await self._poll_compute_setup()
             if status.lower() not in self._vm_started_states:
                 if status.lower() in self._vm_stopped_states:
                     # Assign code 3 == instance stopped.
@@ -444,17 +1243,58 @@ class AMLSpawner(Spawner):
             result = 0
         return result
 
-    # def get_state(self):
-    #     """Get the state of our spawned AzureML resources so that we can persist over restarts."""
-    #     state = super().get_state()
-    #     state["workspace_name"] = self.workspace_name
-    #     state["compute_instance_name"] = self.compute_instance_name
-    #     return state
-
-    # def load_state(self, state):
-    #     """Load previously-defined state so that we can resume where we left off."""
-    #     super().load_state(state)
-    #     if "workspace_name" in state:
-    #         self.workspace_name = state["workspace_name"]
-    #     if "compute_instance_name" in state:
-    #         self.compute_instance_name = state["compute_instance_name"]
+    def get_state(self):
+        """Get the state of our spawned AzureML resources so that we can persist over restarts."""
+        state = super().get_state()
+        for key in self._state_keys:
+            value = getattr(self, key)
+            if value:
+                state[key] = value
+        if self._application_urls:
+            state["application_urls"] = self._application_urls
+        return state
+
+    def load_state(self, state):
+        """
+        Load previously-defined state so that we can resume where we left off.
+
+        This makes no Azure calls: the workspace and compute instance are picked up lazily,
+        from the hub-wide caches, the next time they are needed (e.g. by `poll()`).
+        """
+        super().load_state(state)
+        for key in self._state_keys:
+            if key in state:
+                setattr(self, key, state[key])
+        if "application_urls" in state:
+            self.application_urls = state["application_urls"]
+        if self.from_warm_pool and self.warm_pool_manager is not None:
+            self.warm_pool_manager.mark_claimed(self.compute_instance_name)
+        if self.redirect_path and self._application_urls:
+            self.redirect_server = redirector.RedirectServer.for_address(self.ip, self.redirect_port)
+            self.redirect_server.add_route(self.redirect_path, self._application_urls["Jupyter Lab"])
+
+    def clear_state(self):
+        """Forget the stopped server, but remember the options it was started with, e.g. for `prestart()`."""
+        super().clear_state()
+        if self.from_warm_pool:
+            # Pooled instances are deleted when the server stops.
+            self.compute_instance_name = None
+        self.from_warm_pool = False
+        self.compute_instance = None
+        self.application_urls = None
+        self.redirect_server = None
+        self.redirect_path = None
+
+    async def _reattach(self):
+        """
+        Pick up our workspace and compute instance again, e.g. after a hub restart. Both come
+        from hub-wide caches shared per workspace, so this makes no per-user Azure calls.
+        """
+        if self.workspace is None:
+            self.workspace = await self.workspace_cache.aget(self._workspace_key())
+        if self.compute_instance is None:
+            await self._poll_compute_setup()
+            self.compute_instance = self.compute_status_poller.instance(self.compute_instance_name)
+        if self.redirect_server is not None:
+            await self.redirect_server.start()
+
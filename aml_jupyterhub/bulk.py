@@ -0,0 +1,99 @@
+"""Bulk operations on many servers or compute instances at once, with bounded concurrency."""
+
+import asyncio
+import datetime
+import itertools
+import logging
+
+_jobs = {}
+_job_ids = itertools.count(1)
+
+# How many finished jobs to remember.
+MAX_FINISHED_JOBS = 20
+
+
+class BulkJob:
+    """
+    One bulk operation (e.g. "stop") on many targets. Each target is a name and a coroutine
+    function that carries the operation out on it. At most `concurrency` run at once.
+
+    """
+    def __init__(self, action, targets, concurrency=50, log=None):
+        self.id = str(next(_job_ids))
+        self.action = action
+        self.concurrency = concurrency
+        self.log = log or logging.getLogger(__name__)
+        self.targets = dict(targets)
+        self.results = {name: {"status": "pending"} for name in self.targets}
+        self.created = datetime.datetime.utcnow()
+        self.finished = None
+        self.task = None
+
+    def start(self):
+        _jobs[self.id] = self
+        self.task = asyncio.ensure_future(self._run())
+        self._forget_old_jobs()
+        return self
+
+    async def _run(self):
+        self.log.info(f"Bulk {self.action} of {len(self.targets)} targets started, as job {self.id}.")
+        semaphore = asyncio.Semaphore(self.concurrency)
+        await asyncio.gather(*(self._run_one(name, func, semaphore) for name, func in self.targets.items()))
+        self.finished = datetime.datetime.utcnow()
+        counts = self.counts()
+        self.log.info(f"Bulk {self.action} job {self.id} finished: {counts['succeeded']} succeeded,"
+                      f" {counts['failed']} failed.")
+
+    async def _run_one(self, name, func, semaphore):
+        async with semaphore:
+            self.results[name] = {"status": "running"}
+            try:
+                await func()
+            except Exception as e:
+                self.log.warning(f"Bulk {self.action} of {name} failed: {e}")
+                self.results[name] = {"status": "failed", "error": str(e)}
+            else:
+                self.results[name] = {"status": "succeeded"}
+
+    def counts(self):
+        counts = {"pending": 0, "running": 0, "succeeded": 0, "failed": 0}
+        for result in self.results.values():
+            counts[result["status"]] += 1
+        return counts
+
+    def to_dict(self):
+        counts = self.counts()
+        done = counts["succeeded"] + counts["failed"]
+        return {
+            "id": self.id,
+            "action": self.action,
+            "concurrency": self.concurrency,
+            "created": self.created.isoformat() + "Z",
+            "finished": self.finished.isoformat() + "Z" if self.finished else None,
+            "total": len(self.results),
+            "progress": round(100 * done / len(self.results)) if self.results else 100,
+            "counts": counts,
+            "results": self.results,
+        }
+
+    @staticmethod
+    def _forget_old_jobs():
+        finished = sorted((job for job in _jobs.values() if job.finished), key=lambda job: job.finished)
+        for job in finished[:-MAX_FINISHED_JOBS]:
+            del _jobs[job.id]
+
+
+def get_job(job_id):
+    return _jobs.get(job_id)
+
+
+def list_jobs():
+    return list(_jobs.values())
+
+
+def is_idle(last_activity, idle_seconds, now=None):
+    """Whether a server last active at `last_activity` (a naive UTC datetime, as the hub records it) is idle."""
+    if last_activity is None:
+        return True
+    now = now or datetime.datetime.utcnow()
+    return (now - last_activity).total_seconds() >= idle_seconds
@@ -0,0 +1,165 @@
+"""Hub-wide caches for slow Azure lookups."""
+
+import asyncio
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+_refresh_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="aml-cache")
+
+
+def write_json(path, value):
+    """Write `value` to `path` as JSON. Write then rename, so a crash never leaves a half-written file behind."""
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile("w", dir=directory, delete=False) as f:
+        json.dump(value, f)
+    os.replace(f.name, path)
+
+
+def on_event_loop():
+    """Whether we are running on an event loop's thread, where we must not block."""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+class TTLCache:
+    """
+    A thread-safe cache of values loaded by `loader(key)`.
+
+    A value older than `ttl` seconds is still returned, but triggers a refresh in the
+    background, so callers only ever wait for a key that has never been loaded.
+    Concurrent loads of the same key are collapsed into one call.
+
+    Loads run in `executor` (a `concurrent.futures` executor), or a small pool of our own.
+
+    If `snapshot_path` is set, values are also written there as JSON (via `to_json`
+    and `from_json`) so that a restarted hub can start from the last known values.
+
+    """
+    def __init__(self, loader, ttl, snapshot_path=None, to_json=None, from_json=None, log=None,
+                 executor=None):
+        self.loader = loader
+        self.ttl = ttl
+        self.executor = executor or _refresh_pool
+        self.snapshot_path = snapshot_path
+        self.to_json = to_json or (lambda value: value)
+        self.from_json = from_json or (lambda value: value)
+        self.log = log or logging.getLogger(__name__)
+
+        self._lock = threading.Lock()
+        self._values = {}
+        self._fetched_at = {}
+        self._inflight = {}
+        if self.snapshot_path:
+            self._load_snapshot()
+
+    def _is_stale(self, key):
+        return time.time() - self._fetched_at.get(key, 0) > self.ttl
+
+    def get(self, key):
+        """Return the value for `key`, only blocking if it has never been loaded."""
+        with self._lock:
+            if key in self._values:
+                if self._is_stale(key):
+                    self._refresh_in_background_locked(key)
+                return self._values[key]
+        return self.refresh(key)
+
+    async def aget(self, key):
+        """Like `get`, but waits for a first load without blocking the event loop."""
+        with self._lock:
+            if key in self._values:
+                if self._is_stale(key):
+                    self._refresh_in_background_locked(key)
+                return self._values[key]
+            future = self._refresh_in_background_locked(key)
+        return await asyncio.wrap_future(future)
+
+    def peek(self, key, default=None):
+        """Return the value for `key` without blocking, loading it in the background if needed."""
+        with self._lock:
+            if key not in self._values or self._is_stale(key):
+                self._refresh_in_background_locked(key)
+            return self._values.get(key, default)
+
+    def refresh(self, key):
+        """
+        Load `key` now, or wait for the load that is already running. This blocks, and loaders
+        may need the event loop, so on the event loop use `aget` or `refresh_in_background`.
+        """
+        if on_event_loop():
+            raise RuntimeError(f"Loading {key!r} would block the event loop; use aget() instead.")
+        with self._lock:
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+        if not owner:
+            return future.result()
+
+        try:
+            value = self.loader(key)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            with self._lock:
+                self._values[key] = value
+                self._fetched_at[key] = time.time()
+            future.set_result(value)
+            if self.snapshot_path:
+                self._save_snapshot()
+            return value
+        finally:
+            with self._lock:
+                del self._inflight[key]
+
+    def refresh_in_background(self, key):
+        """Start a refresh of `key` unless one is running. Return a future for its value."""
+        with self._lock:
+            return self._refresh_in_background_locked(key)
+
+    def _refresh_in_background_locked(self, key):
+        if key in self._inflight:
+            return self._inflight[key]
+        return self.executor.submit(self._background_refresh, key)
+
+    def _background_refresh(self, key):
+        try:
+            return self.refresh(key)
+        except Exception:
+            self.log.exception(f"Background refresh of {key!r} failed.")
+            raise
+
+    def invalidate(self, key):
+        with self._lock:
+            self._values.pop(key, None)
+            self._fetched_at.pop(key, None)
+
+    def _load_snapshot(self):
+        try:
+            with open(self.snapshot_path) as f:
+                snapshot = json.load(f)
+            for key, entry in snapshot.items():
+                self._values[key] = self.from_json(entry["value"])
+                self._fetched_at[key] = entry["fetched_at"]
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError, TypeError) as e:
+            self.log.warning(f"Ignoring unreadable cache snapshot {self.snapshot_path}: {e}")
+
+    def _save_snapshot(self):
+        with self._lock:
+            snapshot = {key: {"value": self.to_json(value), "fetched_at": self._fetched_at[key]}
+                        for key, value in self._values.items()}
+        try:
+            write_json(self.snapshot_path, snapshot)
+        except OSError as e:
+            self.log.warning(f"Could not write cache snapshot {self.snapshot_path}: {e}")
@@ -0,0 +1,115 @@
+"""Process-wide registry of Azure credentials and management clients."""
+
+import threading
+import time
+
+from . import sdk
+
+# Refresh the service principal token this many seconds before it expires.
+TOKEN_REFRESH_MARGIN = 300
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+class AzureClients:
+    """
+    The credentials and management clients for one service principal and subscription.
+
+    Every object is built on first use and then shared, so that all spawners in the hub
+    reuse the same tokens and the same pooled HTTP sessions.
+
+    """
+    def __init__(self, tenant_id, client_id, client_secret, subscription_id):
+        self.tenant_id = tenant_id
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.subscription_id = subscription_id
+
+        self._lock = threading.RLock()
+        self._cred = None
+        self._sp_cred = None
+        self._sp_auth = None
+        self._res_mgmt_client = None
+        self._compute_mgmt_client = None
+        self._auth_mgmt_client = None
+
+    @property
+    def cred(self):
+        """An azure-identity credential. It caches and refreshes its own tokens."""
+        with self._lock:
+            if self._cred is None:
+                self._cred = sdk.ClientSecretCredential(
+                    tenant_id=self.tenant_id,
+                    client_id=self.client_id,
+                    client_secret=self.client_secret)
+            return self._cred
+
+    @property
+    def sp_cred(self):
+        """An msrest credential, with its token refreshed shortly before it expires."""
+        with self._lock:
+            if self._sp_cred is None:
+                self._sp_cred = sdk.ServicePrincipalCredentials(
+                    tenant=self.tenant_id,
+                    client_id=self.client_id,
+                    secret=self.client_secret)
+            elif self._token_expiring(self._sp_cred.token):
+                self._sp_cred.set_token()
+            return self._sp_cred
+
+    @property
+    def sp_auth(self):
+        """An AzureML authentication object. It caches and refreshes its own tokens."""
+        with self._lock:
+            if self._sp_auth is None:
+                self._sp_auth = sdk.ServicePrincipalAuthentication(
+                    tenant_id=self.tenant_id,
+                    service_principal_id=self.client_id,
+                    service_principal_password=self.client_secret)
+            return self._sp_auth
+
+    @property
+    def res_mgmt_client(self):
+        with self._lock:
+            sp_cred = self.sp_cred
+            if self._res_mgmt_client is None:
+                self._res_mgmt_client = sdk.ResourceManagementClient(sp_cred, self.subscription_id)
+            return self._res_mgmt_client
+
+    @property
+    def compute_mgmt_client(self):
+        with self._lock:
+            if self._compute_mgmt_client is None:
+                self._compute_mgmt_client = sdk.ComputeManagementClient(self.cred, self.subscription_id)
+            return self._compute_mgmt_client
+
+    @property
+    def auth_mgmt_client(self):
+        with self._lock:
+            sp_cred = self.sp_cred
+            if self._auth_mgmt_client is None:
+                self._auth_mgmt_client = sdk.AuthorizationManagementClient(sp_cred, self.subscription_id)
+            return self._auth_mgmt_client
+
+    @staticmethod
+    def _token_expiring(token):
+        expires_on = (token or {}).get("expires_on")
+        if expires_on is None:
+            return False
+        return float(expires_on) - time.time() < TOKEN_REFRESH_MARGIN
+
+
+def get_clients(tenant_id, client_id, client_secret, subscription_id):
+    """
+    Return the shared `AzureClients` for this service principal and subscription,
+    creating it the first time it is asked for.
+    """
+    key = (tenant_id, client_id, subscription_id)
+    with _registry_lock:
+        clients = _registry.get(key)
+        if clients is None or clients.client_secret != client_secret:
+            # A rotated secret replaces the entry rather than reusing stale credentials.
+            clients = AzureClients(tenant_id, client_id, client_secret, subscription_id)
+            _registry[key] = clients
+        return clients
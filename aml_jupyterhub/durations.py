@@ -0,0 +1,63 @@
+"""A small store of how long compute instances took to reach each state."""
+
+import json
+import logging
+import statistics
+import threading
+
+from .cache import write_json
+
+
+class TransitionDurations:
+    """
+    Recorded durations (in seconds) of compute instance state transitions, per VM size,
+    e.g. how long a `Standard_DS3_v2` took to go from "Creating" to "Running".
+
+    The most recent `max_samples` durations of each transition are kept, and the median is
+    the expected duration. If `path` is set, the durations are kept there as JSON, so they
+    survive a restart of the hub.
+
+    """
+    def __init__(self, path=None, max_samples=50, log=None):
+        self.path = path
+        self.max_samples = max_samples
+        self.log = log or logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._samples = {}
+        if self.path:
+            self._load()
+
+    @staticmethod
+    def _key(vm_size, from_state, to_state):
+        return f"{vm_size}:{from_state.lower()}:{to_state.lower()}"
+
+    def record(self, vm_size, from_state, to_state, seconds):
+        with self._lock:
+            samples = self._samples.setdefault(self._key(vm_size, from_state, to_state), [])
+            samples.append(round(seconds, 1))
+            del samples[:-self.max_samples]
+        if self.path:
+            self._save()
+
+    def expected(self, vm_size, from_state, to_state):
+        """Return the expected duration of the transition, or None if it has never been recorded."""
+        with self._lock:
+            samples = self._samples.get(self._key(vm_size, from_state, to_state))
+            return statistics.median(samples) if samples else None
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                self._samples = {key: list(samples) for key, samples in json.load(f).items()}
+        except FileNotFoundError:
+            pass
+        except (ValueError, TypeError, AttributeError) as e:
+            self.log.warning(f"Ignoring unreadable transition durations {self.path}: {e}")
+
+    def _save(self):
+        with self._lock:
+            samples = dict(self._samples)
+        try:
+            write_json(self.path, samples)
+        except OSError as e:
+            self.log.warning(f"Could not write transition durations {self.path}: {e}")
@@ -0,0 +1,37 @@
+"""Progress events of a spawn, pushed to readers as they happen."""
+
+import asyncio
+
+
+class EventStream:
+    """
+    The `(message, progress)` events of one spawn.
+
+    Any number of readers can follow the stream. Each reader gets every event, from the
+    first one, as soon as it is added, and an idle reader just waits without polling.
+    Events added before the stream is closed are always delivered before it ends.
+
+    """
+    def __init__(self):
+        self.events = []
+        self.closed = False
+        self._changed = asyncio.Event()
+
+    def add(self, msg, progress):
+        if not self.closed:
+            self.events.append((msg, progress))
+            self._wake()
+
+    def close(self):
+        self.closed = True
+        self._wake()
+
+    def _wake(self):
+        # Wake everyone waiting on the current event, and arm a fresh one for the next change.
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def wait(self, seen):
+        """Wait until there are more than `seen` events, or the stream is closed."""
+        while len(self.events) <= seen and not self.closed:
+            await self._changed.wait()
@@ -0,0 +1,36 @@
+"""A bounded thread pool that keeps blocking Azure SDK calls off the event loop."""
+
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AzureExecutor:
+    """
+    Run blocking Azure SDK calls in a fixed-size thread pool, so that the hub's event loop
+    stays responsive and concurrent spawns overlap their I/O.
+
+    Each call is given up on after `timeout` seconds (or the per-call `timeout`). The worker
+    thread cannot be interrupted, so it finishes in the background, but the caller is freed.
+
+    """
+    def __init__(self, max_workers, timeout=None, log=None):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.log = log or logging.getLogger(__name__)
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="aml-azure")
+
+    async def run(self, func, *args, timeout=None, **kwargs):
+        """Run `func(*args, **kwargs)` in the pool and return its result."""
+        loop = asyncio.get_event_loop()
+        future = loop.run_in_executor(self.pool, functools.partial(func, *args, **kwargs))
+        timeout = self.timeout if timeout is None else timeout
+        if not timeout:
+            return await future
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            name = getattr(func, "__qualname__", repr(func))
+            self.log.warning(f"Azure call {name} did not finish within {timeout} seconds.")
+            raise TimeoutError(f"Azure call {name} did not finish within {timeout} seconds.")
@@ -0,0 +1,155 @@
+"""Admin API handlers for the AzureML spawner, to be added to `c.JupyterHub.extra_handlers`."""
+
+import json
+
+from tornado import web
+from jupyterhub import orm
+from jupyterhub.apihandlers.base import APIHandler
+from jupyterhub.utils import admin_only
+
+from . import bulk
+from .aml_spawner import AMLSpawner
+from .poller import ComputeStatusPoller
+from .scheduler import BACKGROUND
+
+
+class StallsAPIHandler(APIHandler):
+    """
+    GET /hub/api/aml/stalls returns the event loop stall statistics as JSON, or with
+    `?format=folded`, the stalled stacks in flamegraph "folded" format.
+    """
+    @admin_only
+    def get(self):
+        detector = AMLSpawner._stall_detector
+        if detector is None:
+            raise web.HTTPError(404, "Stall detection is not enabled; set c.AMLSpawner.stall_threshold.")
+        if self.get_argument("format", "json") == "folded":
+            self.set_header("Content-Type", "text/plain; charset=UTF-8")
+            self.write(detector.folded())
+        else:
+            self.write(json.dumps(detector.stats()))
+
+
+class BulkAPIHandler(APIHandler):
+    """
+    POST /hub/api/aml/bulk starts a bulk operation on many servers at once, and returns the job.
+    The JSON body has:
+
+    - action: "stop" or "start" servers, or "cull" servers idle for `idle_seconds`.
+    - users: (optional) the names of the users whose servers to act on. Defaults to everyone.
+    - idle_seconds: for "cull", how long since the hub last saw activity on a server.
+    - orphans: (optional) for "stop" and "cull", also stop running compute instances, in the
+      workspaces the hub has used, that no server is using.
+    - concurrency: (optional) how many to act on at once. Defaults to c.AMLSpawner.bulk_concurrency.
+
+    Servers are stopped and started through the hub, as if each user had asked. GET
+    /hub/api/aml/bulk lists the jobs, and GET /hub/api/aml/bulk/<id> shows one job's progress.
+    """
+    @admin_only
+    def get(self, job_id=None):
+        if job_id is None:
+            self.write(json.dumps([job.to_dict() for job in bulk.list_jobs()]))
+            return
+        job = bulk.get_job(job_id)
+        if job is None:
+            raise web.HTTPError(404, f"No such bulk job: {job_id}")
+        self.write(json.dumps(job.to_dict()))
+
+    @admin_only
+    async def post(self, job_id=None):
+        body = self.get_json_body() or {}
+        action = body.get("action")
+        if action not in ("stop", "start", "cull"):
+            raise web.HTTPError(400, "action must be one of 'stop', 'start' or 'cull'.")
+        if action == "cull" and not isinstance(body.get("idle_seconds"), (int, float)):
+            raise web.HTTPError(400, "cull needs idle_seconds.")
+        concurrency = body.get("concurrency")
+        if concurrency is not None and (not isinstance(concurrency, int) or isinstance(concurrency, bool)
+                                        or concurrency < 1):
+            raise web.HTTPError(400, "concurrency must be a positive integer.")
+
+        # Only starting needs the servers that aren't running.
+        spawners = self._spawners(body.get("users"), stopped=action == "start")
+        if action == "start":
+            targets = {f"{user.name}/{name}": self._starter(user, name)
+                       for user, name, spawner in spawners
+                       if not spawner.active and spawner.compute_instance_name}
+        else:
+            targets = {f"{user.name}/{name}": self._stopper(user, name)
+                       for user, name, spawner in spawners
+                       if spawner.ready and (action == "stop" or bulk.is_idle(spawner.orm_spawner.last_activity,
+                                                                                body["idle_seconds"]))}
+            if body.get("orphans"):
+                targets.update(await self._orphan_stoppers())
+
+        default_concurrency = spawners[0][2].bulk_concurrency if spawners else AMLSpawner.bulk_concurrency.default_value
+        job = bulk.BulkJob(action, targets, concurrency=concurrency or default_concurrency, log=self.log).start()
+        self.set_status(202)
+        self.write(json.dumps(job.to_dict()))
+
+    def _spawners(self, usernames, stopped=False):
+        """
+        Return `(user, server name, spawner)` for each AzureML server of the chosen users, that is
+        running (or starting or stopping), or if `stopped`, for every server.
+        """
+        query = self.db.query(orm.User)
+        if usernames is not None:
+            query = query.filter(orm.User.name.in_(usernames))
+        spawners = []
+        for orm_user in query:
+            user = self.users[orm_user]
+            # After a restart, the hub only makes spawners for running servers; make the rest.
+            for name, orm_spawner in user.orm_spawners.items():
+                if not stopped and orm_spawner.server is None and name not in user.spawners:
+                    continue
+                spawner = user.spawners[name]
+                if isinstance(spawner, AMLSpawner):
+                    spawners.append((user, name, spawner))
+        return spawners
+
+    def _stopper(self, user, name):
+        async def stop():
+            spawner = user.spawners[name]
+            await self.stop_single_user(user, name)
+            # The hub stops slow servers in the background, so wait for it.
+            if getattr(spawner, "_stop_future", None):
+                await spawner._stop_future
+            if spawner.active:
+                raise RuntimeError("The server did not stop.")
+        return stop
+
+    def _starter(self, user, name):
+        async def start():
+            spawner = user.spawners[name]
+            await self.spawn_single_user(user, name)
+            # The hub finishes slow spawns in the background, so wait for it.
+            if getattr(spawner, "_spawn_future", None):
+                await spawner._spawn_future
+            if not spawner.ready:
+                raise RuntimeError("The server did not start.")
+        return start
+
+    async def _orphan_stoppers(self):
+        """Return a stop for each running compute instance that no server is using."""
+        in_use = set(AMLSpawner._prestarts)
+        for _, _, spawner in self._spawners(None):
+            if spawner.active and spawner.compute_instance_name:
+                in_use.add(spawner.compute_instance_name)
+        scheduler = AMLSpawner._azure_scheduler
+        stoppers = {}
+        for poller in list(ComputeStatusPoller._pollers.values()):
+            await poller.refresh()
+            for name, state in poller.states().items():
+                # Only the instances that spawners name, not e.g. warm pool instances.
+                if name.startswith("ci-") and state.lower() in AMLSpawner._vm_started_states and name not in in_use:
+                    instance = poller.instance(name)
+                    stoppers[f"{poller.workspace.name}/{name}"] = (
+                        lambda instance=instance: scheduler.call(instance.stop, write=True, priority=BACKGROUND))
+        return stoppers
+
+
+default_handlers = [
+    (r"/api/aml/stalls", StallsAPIHandler),
+    (r"/api/aml/bulk", BulkAPIHandler),
+    (r"/api/aml/bulk/([^/]+)", BulkAPIHandler),
+]
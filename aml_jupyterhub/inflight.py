@@ -0,0 +1,90 @@
+"""Single-flight registry of the operations under way on each compute instance."""
+
+import asyncio
+import logging
+
+
+class Operation:
+    """
+    One operation (e.g. "start") under way on a compute instance.
+
+    Progress events emitted by the operation are recorded, and passed on to everyone who
+    joined it, so each waiter can show its own progress.
+
+    """
+    def __init__(self, kind, owner=None):
+        self.kind = kind
+        self.owner = owner
+        self.events = []
+        self.listeners = []
+        self.task = None
+
+    def emit(self, msg, progress):
+        self.events.append((msg, progress))
+        for listener in list(self.listeners):
+            listener(msg, progress)
+
+    async def join(self, on_event):
+        """Replay the events so far to `on_event`, then pass on new ones until the operation finishes."""
+        for msg, progress in self.events:
+            on_event(msg, progress)
+        self.listeners.append(on_event)
+        try:
+            return await asyncio.shield(self.task)
+        finally:
+            self.listeners.remove(on_event)
+
+    async def wait(self, timeout=None):
+        """Wait for the operation to finish, whether or not it succeeds. Return whether it did."""
+        done, _ = await asyncio.wait([self.task], timeout=timeout)
+        return bool(done)
+
+
+class InflightOperations:
+    """
+    The operations under way, keyed by compute instance name.
+
+    A request for the same kind of operation that is already under way joins it, instead of
+    sending Azure a duplicate request. A request for a different kind (e.g. a stop while a
+    start is under way) cancels the current one if the same `owner` started it, and otherwise
+    waits up to `wait_timeout` seconds for it to finish first.
+
+    """
+    def __init__(self, log=None):
+        self.operations = {}
+        self.log = log or logging.getLogger(__name__)
+
+    async def run(self, key, kind, factory, on_event, owner=None, wait_timeout=None):
+        """
+        Run `factory(operation)` as the `kind` operation on `key`, or join the one under way.
+        `on_event(msg, progress)` is only called for events of an operation we joined; the
+        caller that started the operation sees its own events directly.
+        """
+        while True:
+            operation = self.operations.get(key)
+            if operation is None:
+                break
+            if operation.kind == kind:
+                return await operation.join(on_event)
+            if owner is not None and operation.owner is owner:
+                # E.g. the hub stopping a spawn that timed out: the start is no longer wanted.
+                self.log.info(f"Cancelling the {operation.kind} of {key} for a {kind}.")
+                operation.task.cancel()
+                await operation.wait()
+            elif not await operation.wait(wait_timeout):
+                self.log.warning(f"The {operation.kind} of {key} is taking too long; going ahead with a {kind}.")
+                break
+
+        operation = self.operations[key] = Operation(kind, owner)
+        operation.task = asyncio.ensure_future(factory(operation))
+        operation.task.add_done_callback(lambda _: self._finished(key, operation))
+        # Shielded, so that others who joined aren't cancelled along with us.
+        return await asyncio.shield(operation.task)
+
+    def _finished(self, key, operation):
+        if self.operations.get(key) is operation:
+            del self.operations[key]
+
+    def get(self, key):
+        """Return the operation under way on `key`, or None."""
+        return self.operations.get(key)
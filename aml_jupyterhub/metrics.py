@@ -0,0 +1,65 @@
+"""
+Prometheus metrics exported by the AzureML spawner.
+
+The metrics are registered with the default prometheus_client registry, so JupyterHub serves
+them from its own `/hub/metrics` endpoint alongside the `jupyterhub_` metrics. They follow the
+same naming conventions, with an `aml_spawner_` prefix.
+"""
+import time
+from contextlib import contextmanager
+
+from prometheus_client import Counter, Gauge, Histogram
+
+PHASE_DURATION_SECONDS = Histogram(
+    'aml_spawner_phase_duration_seconds',
+    'time taken for each phase of starting or stopping a server',
+    ['operation', 'phase', 'vm_size', 'workspace', 'status'],
+    # Creating or starting a compute instance can take many minutes.
+    buckets=[0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 240, 480, 900, 1800, float("inf")],
+)
+
+AZURE_CALLS = Counter(
+    'aml_spawner_azure_calls_total',
+    'number of Azure SDK calls made',
+    ['call', 'status'],
+)
+
+AZURE_CALL_DURATION_SECONDS = Histogram(
+    'aml_spawner_azure_call_duration_seconds',
+    'time taken for Azure SDK calls, excluding time spent waiting for the rate limit',
+    ['call'],
+)
+
+AZURE_RETRIES = Counter(
+    'aml_spawner_azure_retries_total',
+    'number of Azure SDK calls retried after being throttled',
+    ['call'],
+)
+
+EVENT_LOOP_LAG_SECONDS = Histogram(
+    'aml_spawner_event_loop_lag_seconds',
+    'how late the event loop ran a timer, when stall detection is enabled',
+    buckets=[0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float("inf")],
+)
+
+REDIRECT_ROUTES = Gauge(
+    'aml_spawner_redirect_routes',
+    'the number of routes on the redirect server, i.e. servers being redirected to compute instances',
+)
+
+
+@contextmanager
+def time_phase(operation, phase, vm_size, workspace):
+    """Record how long the body takes as `phase` of `operation` ("start" or "stop")."""
+    started_at = time.perf_counter()
+    status = "success"
+    try:
+        yield
+    except BaseException:
+        status = "failure"
+        raise
+    finally:
+        PHASE_DURATION_SECONDS.labels(
+            operation=operation, phase=phase, vm_size=vm_size or "", workspace=workspace or "",
+            status=status,
+        ).observe(time.perf_counter() - started_at)
@@ -0,0 +1,91 @@
+"""Run the steps of an operation, e.g. a spawn, as soon as the steps they depend on are done."""
+
+import asyncio
+import contextvars
+import logging
+import time
+
+# The step the current task is running, so `Pipeline.result` knows who is waiting.
+_current_step = contextvars.ContextVar("current_step", default=None)
+
+
+class Pipeline:
+    """
+    A graph of named steps, each a coroutine function that takes no arguments.
+
+    Each step starts as soon as the steps it `needs` have finished, so steps that don't depend
+    on each other run at the same time. A step may also wait part way through for another step
+    that it only sometimes needs, with `result`. If any step fails, the others are cancelled
+    and `run` raises its exception.
+
+    After a run, `critical_path` is the chain of steps that the whole run waited for.
+
+    """
+    def __init__(self, log=None):
+        self.log = log or logging.getLogger(__name__)
+        self._steps = {}
+        self._tasks = {}
+        # Step -> the steps it waited for, whether it `needs` them or asked for their `result`.
+        self._waited_for = {}
+        self.started = {}
+        self.finished = {}
+
+    def add(self, name, func, needs=()):
+        self._steps[name] = (func, tuple(needs))
+        self._waited_for[name] = set(needs)
+
+    async def result(self, name):
+        """Wait for step `name` and return its result."""
+        waiter = _current_step.get()
+        if waiter is not None:
+            self._waited_for[waiter].add(name)
+        return await asyncio.shield(self._tasks[name])
+
+    async def _run_step(self, name):
+        func, needs = self._steps[name]
+        for need in needs:
+            await asyncio.shield(self._tasks[need])
+        _current_step.set(name)
+        self.started[name] = time.monotonic()
+        try:
+            return await func()
+        finally:
+            self.finished[name] = time.monotonic()
+
+    async def run(self):
+        """Run every step. Return the results by step name."""
+        unknown = {need for _, needs in self._steps.values() for need in needs} - self._steps.keys()
+        if unknown:
+            raise ValueError(f"Steps needed but not added: {', '.join(sorted(unknown))}")
+        for name in self._steps:
+            self._tasks[name] = asyncio.ensure_future(self._run_step(name))
+        try:
+            done, pending = await asyncio.wait(self._tasks.values(), return_when=asyncio.FIRST_EXCEPTION)
+        except BaseException:
+            # We were cancelled, so nobody wants the steps' results.
+            for task in self._tasks.values():
+                task.cancel()
+            raise
+        failed = [task for task in done if not task.cancelled() and task.exception() is not None]
+        if failed:
+            for task in pending:
+                task.cancel()
+            await asyncio.wait(self._tasks.values())
+            raise failed[0].exception()
+        return {name: task.result() for name, task in self._tasks.items()}
+
+    def critical_path(self):
+        """
+        Return `[(step, seconds), ...]`: the step that finished last, preceded by the step it
+        waited for that finished last, and so on back to the start of the run.
+        """
+        path = []
+        name = max(self.finished, key=self.finished.get, default=None)
+        while name is not None:
+            path.append((name, self.finished[name] - self.started.get(name, self.finished[name])))
+            waited_for = [step for step in self._waited_for[name] if step in self.finished]
+            name = max(waited_for, key=self.finished.get, default=None)
+        return path[::-1]
+
+    def describe_critical_path(self):
+        return " > ".join(f"{name} {seconds:.1f}s" for name, seconds in self.critical_path())
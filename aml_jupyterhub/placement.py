@@ -0,0 +1,55 @@
+"""Choose VM sizes that the subscription has the AzureML quota to run."""
+
+import requests
+
+MANAGEMENT_URL = "https://management.azure.com"
+USAGES_PATH = ("/subscriptions/{subscription_id}/providers/Microsoft.MachineLearningServices"
+               "/locations/{location}/usages")
+USAGES_API_VERSION = "2020-08-01"
+
+
+def list_usages(cred, subscription_id, location):
+    """
+    Return the AzureML vCPU usage and quota in `location`, as `{family: (used, limit)}`
+    (e.g. `{"standardDSv2Family": (12, 24)}`). This makes one or more ARM requests,
+    so go through `AMLSpawner.usage_cache` instead.
+    """
+    token = cred.get_token(f"{MANAGEMENT_URL}/.default").token
+    url = MANAGEMENT_URL + USAGES_PATH.format(subscription_id=subscription_id, location=location)
+    params = {"api-version": USAGES_API_VERSION}
+    usages = {}
+    while url:
+        response = requests.get(url, params=params, headers={"Authorization": f"Bearer {token}"},
+                                timeout=60)
+        response.raise_for_status()
+        body = response.json()
+        for usage in body.get("value", []):
+            if "/workspaces/" in usage.get("type", ""):
+                # A per-workspace breakdown of the subscription's usage.
+                continue
+            usages[usage["name"]["value"]] = (usage["currentValue"], usage["limit"])
+        # The next link already carries the query string.
+        url, params = body.get("nextLink"), None
+    return usages
+
+
+def headroom(sku, usages):
+    """Return how many more VMs of `sku` the quota allows, or None if we don't know."""
+    if not usages or sku.get("family") not in usages or not sku.get("vcpus"):
+        return None
+    used, limit = usages[sku["family"]]
+    return max(0, limit - used) // sku["vcpus"]
+
+
+def choose_vm_size(candidates, skus, usages):
+    """
+    Return `(vm_size, full)` for the first of `candidates` that is offered in the region
+    (`skus`, by name) and has quota left. If every offered candidate is out of quota,
+    return the first of them with `full` True, or `(None, False)` if none is offered.
+    """
+    offered = [vm for vm in candidates if vm in skus]
+    for vm in offered:
+        room = headroom(skus[vm], usages)
+        if room is None or room > 0:
+            return vm, False
+    return (offered[0], True) if offered else (None, False)
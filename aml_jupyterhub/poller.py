@@ -0,0 +1,149 @@
+"""A shared poller for the state of the compute instances in a workspace."""
+
+import asyncio
+import logging
+import time
+
+from . import sdk
+from .scheduler import BACKGROUND
+
+UNKNOWN_STATE = "Unknown"
+
+
+class ComputeStatusPoller:
+    """
+    Poll the state of every compute instance in one workspace with a single list call.
+
+    States are cached for `interval` seconds, so any number of spawners asking about
+    instances in the same workspace cost one Azure request per interval. While anyone is
+    subscribed to an instance, the poller keeps listing in the background and pushes each
+    change of state to the subscribers' queues. Subscribers may ask for the next listing
+    sooner or later than `interval` with `poll_after`, e.g. to poll less often while they
+    expect nothing to change.
+
+    """
+    _pollers = {}
+
+    @classmethod
+    def for_workspace(cls, workspace, run, interval=5, log=None):
+        """Return the poller shared by everyone using `workspace`, creating it if needed."""
+        key = (workspace.subscription_id, workspace.resource_group, workspace.name)
+        poller = cls._pollers.get(key)
+        if poller is None:
+            poller = cls._pollers[key] = cls(workspace, run, interval=interval, log=log)
+        return poller
+
+    def __init__(self, workspace, run, interval=5, log=None):
+        self.workspace = workspace
+        # `run` makes a blocking SDK call off the event loop, i.e. `AzureScheduler.call`.
+        self.run = run
+        self.interval = interval
+        self.log = log or logging.getLogger(__name__)
+
+        self._statuses = {}
+        self._instances = {}
+        self._fetched_at = None
+        self._refreshing = None
+        self._subscribers = {}
+        self._wanted = {}
+        self._rescheduled = asyncio.Event()
+        self._task = None
+
+    async def status(self, name, max_age=None, priority=BACKGROUND):
+        """
+        Return `(state, errors)` for the named compute instance, listing the workspace
+        again only if the cached states are older than `max_age` (default `interval`) seconds.
+        """
+        max_age = self.interval if max_age is None else max_age
+        if self._fetched_at is None or time.monotonic() - self._fetched_at >= max_age:
+            await self.refresh(priority)
+        elif name not in self._statuses:
+            # Probably created since we last looked.
+            await self.refresh(priority)
+        return self._statuses.get(name, (UNKNOWN_STATE, []))
+
+    def states(self):
+        """Return the state of every compute instance in the latest listing, by name."""
+        return {name: state for name, (state, _) in self._statuses.items()}
+
+    def instance(self, name):
+        """Return the `ComputeInstance` from the latest listing, or None."""
+        return self._instances.get(name)
+
+    async def refresh(self, priority=BACKGROUND):
+        """List the workspace's compute instances, or wait for the listing already running."""
+        if self._refreshing is None:
+            self._refreshing = asyncio.ensure_future(self._refresh(priority))
+        await asyncio.shield(self._refreshing)
+
+    async def _refresh(self, priority):
+        try:
+            targets = await self.run(sdk.ComputeTarget.list, self.workspace, priority=priority)
+            instances = {t.name: t for t in targets if isinstance(t, sdk.ComputeInstance)}
+            statuses = {}
+            for name, instance in instances.items():
+                status = instance.status
+                statuses[name] = (status.state, status.errors or []) if status else (UNKNOWN_STATE, [])
+            previous, self._statuses = self._statuses, statuses
+            self._instances = instances
+            self._fetched_at = time.monotonic()
+            self._wanted = {queue: due for queue, due in self._wanted.items() if due > self._fetched_at}
+        finally:
+            self._refreshing = None
+
+        for name, queues in self._subscribers.items():
+            status = statuses.get(name, (UNKNOWN_STATE, []))
+            if previous.get(name, (None, None))[0] != status[0]:
+                for queue in queues:
+                    queue.put_nowait(status)
+
+    def subscribe(self, name):
+        """Return a queue that receives the `(state, errors)` of the named instance when it changes."""
+        queue = asyncio.Queue()
+        self._subscribers.setdefault(name, set()).add(queue)
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._poll_while_subscribed())
+        return queue
+
+    def unsubscribe(self, name, queue):
+        queues = self._subscribers.get(name, set())
+        queues.discard(queue)
+        self._wanted.pop(queue, None)
+        if not queues:
+            self._subscribers.pop(name, None)
+
+    def poll_after(self, queue, delay):
+        """
+        Ask for a background listing within `delay` seconds on behalf of the subscriber `queue`,
+        instead of after the usual `interval`. An earlier request still outstanding is kept.
+        """
+        due = time.monotonic() + delay
+        self._wanted[queue] = min(due, self._wanted.get(queue, due))
+        self._rescheduled.set()
+
+    def _next_poll_at(self):
+        """The earliest time any subscriber wants a listing by."""
+        default = (self._fetched_at or 0) + self.interval
+        return min((self._wanted.get(queue, default)
+                    for queues in self._subscribers.values() for queue in queues), default=default)
+
+    async def _sleep_until_wanted(self):
+        while True:
+            self._rescheduled.clear()
+            delay = self._next_poll_at() - time.monotonic()
+            if delay <= 0:
+                return
+            try:
+                await asyncio.wait_for(self._rescheduled.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                return
+
+    async def _poll_while_subscribed(self):
+        while self._subscribers:
+            await self._sleep_until_wanted()
+            if not self._subscribers:
+                break
+            try:
+                await self.refresh()
+            except Exception as e:
+                self.log.warning(f"Could not list compute instances in {self.workspace.name}: {e}")
@@ -1,73 +1,111 @@
-import time
-import http.server
-import socketserver
-import multiprocessing
+"""A redirect server, inside the hub, that sends each user on to their compute instance."""
 
+import asyncio
+import logging
+from urllib.parse import urlsplit
 
-def redirect_handler_factory(url):
-    """
-    Returns a request handler class that redirects to supplied `url`
-    """
-    class RedirectHandler(http.server.SimpleHTTPRequestHandler):
-        def do_GET(self):
-            self.send_response(302)
-            self.send_header('Location', url)
-            self.end_headers()
+from .metrics import REDIRECT_ROUTES
 
-    return RedirectHandler
+log = logging.getLogger(__name__)
 
 
-def _create_server(url, port):
-    port = port
-    with socketserver.TCPServer(("", port), redirect_handler_factory(url)) as httpd:
-        print("serving at port", port)
-        httpd.serve_forever()
+def _normalize_path(path):
+    """Return `path` with exactly one trailing slash, so prefixes compare segment by segment."""
+    return path.rstrip("/") + "/"
 
 
 class RedirectServer:
-    _start_port = 9001
-    _redirects = {}
+    """
+    A single asyncio HTTP listener that answers with a 302 to each server's JupyterLab URL.
 
-    @classmethod
-    def get_existing_redirect(cls, url):
-        port = cls._redirects.get(url)
-        return ("0.0.0.0", port) if port else None
+    The proxy sends requests for a server's URL prefix (e.g. `/user/alice/`) here with the
+    path intact, so the routes are a dict keyed by that prefix. Adding or removing a route
+    is a dict operation, and every user shares the same listener and port.
+
+    """
+    _servers = {}
+    request_timeout = 10
 
     @classmethod
-    def _get_free_port(cls):
-        port = cls._start_port
-        taken = list(cls._redirects.values())
-        while port in taken:
-            port += 1
-        return port
-
-    def __init__(self, redirect_to_url):
-        self.url = redirect_to_url
-        super().__init__()
-
-    def start(self):
-
-        print('start')
-        self.port = RedirectServer._get_free_port()
-        self.server_process = multiprocessing.Process(target=_create_server, args=[self.url, self.port], daemon=True)
-        self.server_process.start()
-        RedirectServer._redirects[self.url] = self.port
-
-    def stop(self):
-        try:
-            # Using .kill() instead of .terminate(), as apparently JupyterHub
-            # end up observing a SIGTERM signal when .terminate() is used which
-            # causes it to shut down. Note that SIGTERM is like a kind request,
-            # while SIGKILL is a forceful demand, and we don't mind shutting
-            # down the redirection server process forcefully.
-            self.server_process.kill()
-            del RedirectServer._redirects[self.url]
-
-        except Exception as e:
-            print(e)
-            raise e
-        pass
+    def for_address(cls, ip, port):
+        """Return the redirect server listening on `ip`:`port`, creating it if needed."""
+        server = cls._servers.get((ip, port))
+        if server is None:
+            server = cls._servers[(ip, port)] = cls(ip, port)
+        return server
+
+    def __init__(self, ip, port):
+        self.ip = ip
+        self.port = port
+        self.routes = {}
+        self._server = None
+        self._starting = None
 
     @property
     def route(self):
-        return ("0.0.0.0", self.port)
+        """Our `(ip, port)`. With port 0, the port we were given once we are listening."""
+        if self._server is not None and self._server.sockets:
+            return (self.ip, self._server.sockets[0].getsockname()[1])
+        return (self.ip, self.port)
+
+    async def start(self):
+        """Start listening, if we aren't already. Returns once connections are being accepted."""
+        if self._starting is None:
+            self._starting = asyncio.ensure_future(self._start())
+        try:
+            await asyncio.shield(self._starting)
+        except Exception:
+            # Let the next caller try again.
+            self._starting = None
+            raise
+
+    async def _start(self):
+        self._server = await asyncio.start_server(self._handle, self.ip, self.port)
+        log.info(f"Redirect server listening on {self.ip}:{self.route[1]}.")
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+            self._starting = None
+
+    def add_route(self, path, url):
+        path = _normalize_path(path)
+        if path not in self.routes:
+            REDIRECT_ROUTES.inc()
+        self.routes[path] = url
+
+    def remove_route(self, path):
+        if self.routes.pop(_normalize_path(path), None) is not None:
+            REDIRECT_ROUTES.dec()
+
+    def lookup(self, path):
+        """Return the URL to redirect `path` to, from the longest matching route prefix."""
+        segments = path.split("/")
+        for i in range(len(segments), 0, -1):
+            url = self.routes.get(_normalize_path("/".join(segments[:i])))
+            if url is not None:
+                return url
+        return None
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), self.request_timeout)
+            # We don't need the headers, but have to read them before answering.
+            while True:
+                line = await asyncio.wait_for(reader.readline(), self.request_timeout)
+                if line in (b"\r\n", b"\n", b""):
+                    break
+            _, target, _ = request_line.decode("latin-1").split(" ", 2)
+            url = self.lookup(urlsplit(target).path)
+            if url is None:
+                response = "HTTP/1.1 404 Not Found\r\n"
+            else:
+                response = f"HTTP/1.1 302 Found\r\nLocation: {url}\r\n"
+            writer.write((response + "Content-Length: 0\r\nConnection: close\r\n\r\n").encode("latin-1"))
+            await writer.drain()
+        except (ValueError, asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
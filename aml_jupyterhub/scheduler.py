@@ -0,0 +1,175 @@
+"""Rate limiting, prioritisation and retrying of Azure calls."""
+
+import asyncio
+import concurrent.futures
+import heapq
+import itertools
+import logging
+import random
+import re
+import time
+
+from .cache import on_event_loop
+from .metrics import AZURE_CALLS, AZURE_CALL_DURATION_SECONDS, AZURE_RETRIES
+
+# Priorities: lower values are served first.
+INTERACTIVE = 0
+BACKGROUND = 1
+
+THROTTLED_REGEX = re.compile(r'\b429\b|TooManyRequests|throttl', re.IGNORECASE)
+
+
+def retry_after(exc):
+    """
+    Return how long (in seconds) Azure asked us to wait before retrying, 0 if we were throttled
+    without being told how long to wait, or None if `exc` isn't a throttling error.
+    """
+    response = getattr(exc, "response", None)
+    status_code = getattr(exc, "status_code", None) or getattr(response, "status_code", None)
+    if status_code not in (429, 503) and not THROTTLED_REGEX.search(str(exc)):
+        return None
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return float(headers.get("Retry-After", 0))
+    except ValueError:
+        # Retry-After may also be an HTTP date, which isn't worth parsing for a backoff.
+        return 0.0
+
+
+class TokenBucket:
+    """Allow `rate` calls per second on average, in bursts of up to `burst` calls."""
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self):
+        """Return how long until a token is available, or 0 if one is available now."""
+        self._refill()
+        wait = max(0, self.paused_until - time.monotonic())
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+    def take(self):
+        self.tokens -= 1
+
+    def pause(self, seconds):
+        """Hand out no tokens for `seconds`, e.g. because Azure told us to back off."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class AzureScheduler:
+    """
+    The single route by which the spawners make Azure calls.
+
+    Reads and writes each have a token bucket, matching the separate read and write limits
+    that ARM applies per subscription. Calls waiting for a token are served in order of
+    priority, so interactive spawns go ahead of background polling. A throttled call pauses
+    its bucket for the `Retry-After` Azure asked for, and is retried with jittered
+    exponential backoff up to `max_retries` times. The calls themselves run in `executor`.
+
+    """
+    def __init__(self, executor, read_rate=10, write_rate=1, burst=20, max_retries=5,
+                 backoff_base=1, backoff_max=60, log=None):
+        self.executor = executor
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.log = log or logging.getLogger(__name__)
+        self.loop = asyncio.get_event_loop()
+
+        self._buckets = {False: TokenBucket(read_rate, burst), True: TokenBucket(write_rate, burst)}
+        self._waiters = {False: [], True: []}
+        self._wakeups = {False: None, True: None}
+        self._counter = itertools.count()
+
+    async def call(self, func, *args, write=False, priority=INTERACTIVE, timeout=None, **kwargs):
+        """Make the blocking call `func(*args, **kwargs)` once our rate budget allows, retrying if throttled."""
+        name = getattr(func, "__qualname__", repr(func))
+        for attempt in itertools.count():
+            await self._acquire(write, priority)
+            started_at = time.perf_counter()
+            try:
+                result = await self.executor.run(func, *args, timeout=timeout, **kwargs)
+            except Exception as e:
+                AZURE_CALLS.labels(call=name, status="failure").inc()
+                wait = retry_after(e)
+                if wait is None or attempt >= self.max_retries:
+                    raise
+                backoff = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+                wait = max(wait, random.uniform(0, backoff))
+                AZURE_RETRIES.labels(call=name).inc()
+                self.log.warning(f"Azure throttled {name}; retrying in {wait:.1f} seconds.")
+                self._buckets[write].pause(wait)
+                await asyncio.sleep(wait)
+            else:
+                AZURE_CALLS.labels(call=name, status="success").inc()
+                return result
+            finally:
+                AZURE_CALL_DURATION_SECONDS.labels(call=name).observe(time.perf_counter() - started_at)
+
+    def call_threadsafe(self, func, *args, **kwargs):
+        """
+        Like `call`, but for use from a thread other than the event loop's. Blocks until done,
+        or until the call and its retries have surely timed out, or the event loop stops.
+        """
+        if on_event_loop():
+            # Waiting here would stop the loop from ever making the call.
+            raise RuntimeError(f"call_threadsafe({func!r}) called on the event loop; await call() instead.")
+        name = getattr(func, "__qualname__", repr(func))
+        future = asyncio.run_coroutine_threadsafe(self.call(func, *args, **kwargs), self.loop)
+        deadline = self._threadsafe_deadline(kwargs.get("timeout"))
+        while True:
+            try:
+                # Wake up now and then to check the loop is still there to make the call.
+                return future.result(timeout=1)
+            except concurrent.futures.TimeoutError:
+                if self.loop.is_closed() or not self.loop.is_running():
+                    future.cancel()
+                    raise RuntimeError(f"The event loop stopped before Azure call {name} finished.")
+                if deadline is not None and time.monotonic() >= deadline:
+                    future.cancel()
+                    raise TimeoutError(f"Azure call {name} did not finish in time.")
+
+    def _threadsafe_deadline(self, timeout):
+        """When a call, with all its retries, must have finished by, or None if calls can take for ever."""
+        timeout = self.executor.timeout if timeout is None else timeout
+        if not timeout:
+            return None
+        return time.monotonic() + (self.max_retries + 1) * (timeout + self.backoff_max)
+
+    async def _acquire(self, write, priority):
+        future = self.loop.create_future()
+        heapq.heappush(self._waiters[write], (priority, next(self._counter), future))
+        self._dispatch(write)
+        await future
+
+    def _wake(self, write):
+        self._wakeups[write] = None
+        self._dispatch(write)
+
+    def _dispatch(self, write):
+        """Hand out tokens to the highest priority waiters, and come back when the next one is due."""
+        bucket, waiters = self._buckets[write], self._waiters[write]
+        while waiters:
+            _, _, future = waiters[0]
+            if future.done():
+                # The caller gave up, e.g. it was cancelled.
+                heapq.heappop(waiters)
+                continue
+            delay = bucket.delay()
+            if delay > 0:
+                if self._wakeups[write] is None:
+                    self._wakeups[write] = self.loop.call_later(delay, self._wake, write)
+                return
+            heapq.heappop(waiters)
+            bucket.take()
+            future.set_result(None)
@@ -0,0 +1,56 @@
+"""
+The Azure and AzureML SDK names used by the spawner, imported on first use.
+
+The SDKs take seconds, and a lot of memory, to import. JupyterHub imports the spawner class
+whenever it starts (or checks its config), so we only import them when they are first needed,
+e.g. `sdk.ComputeInstance`, and `preload()` does that in the background.
+"""
+
+import importlib
+import logging
+import threading
+
+_MODULES = {
+    "Workspace": "azureml.core",
+    "ComputeInstance": "azureml.core.compute",
+    "ComputeTarget": "azureml.core.compute",
+    "ComputeTargetException": "azureml.exceptions",
+    "ServicePrincipalAuthentication": "azureml.core.authentication",
+    "ClientSecretCredential": "azure.identity",
+    "ServicePrincipalCredentials": "azure.common.credentials",
+    "ResourceManagementClient": "azure.mgmt.resource",
+    "ComputeManagementClient": "azure.mgmt.compute",
+    "AuthorizationManagementClient": "azure.mgmt.authorization",
+}
+
+_preloading = None
+
+
+def __getattr__(name):
+    module = _MODULES.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(module), name)
+    # Later lookups find the name directly, without coming back here.
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_MODULES))
+
+
+def preload():
+    """Import the SDKs in a background thread, so the first Azure call doesn't wait for them."""
+    global _preloading
+    if _preloading is None:
+        _preloading = threading.Thread(target=_import_all, name="aml-sdk-preload", daemon=True)
+        _preloading.start()
+
+
+def _import_all():
+    for name in _MODULES:
+        try:
+            __getattr__(name)
+        except Exception as e:
+            logging.getLogger(__name__).warning(f"Could not import {name} from {_MODULES[name]}: {e}")
@@ -0,0 +1,182 @@
+"""Detect stalls of the hub's event loop, and attribute them to the code that was running."""
+
+import collections
+import logging
+import sys
+import threading
+import time
+
+from .metrics import EVENT_LOOP_LAG_SECONDS
+
+# Modules whose frames name the spawner code, and the Azure SDK call, that a stall came from.
+OUR_PACKAGE = __name__.split(".")[0]
+AZURE_PACKAGES = ("azure", "azureml", "msrest", "msrestazure", "adal", "msal")
+
+
+def _qualname(code, module):
+    """The qualified name of the function running `code` (`co_qualname` is new in Python 3.11)."""
+    qualname = getattr(code, "co_qualname", None)
+    if qualname is None:
+        qualname = _method_names(module).get(code, code.co_name)
+    return qualname
+
+
+_method_name_cache = {}
+
+
+def _method_names(module_name):
+    """Map each code object of the functions and methods in `module_name` to its qualified name."""
+    names = _method_name_cache.get(module_name)
+    if names is None:
+        names = {}
+        module = sys.modules.get(module_name)
+        for value in vars(module).values() if module else ():
+            members = vars(value).values() if isinstance(value, type) else [value]
+            for member in members:
+                func = getattr(member, "fget", None) or getattr(member, "__func__", member)
+                code = getattr(func, "__code__", None)
+                if code is not None:
+                    names[code] = func.__qualname__
+        _method_name_cache[module_name] = names
+    return names
+
+
+class StallDetector:
+    """
+    Measure the lag of the event loop continuously, and find out what blocked it.
+
+    A heartbeat on the loop runs every `interval` seconds, and records how late it was. A
+    watchdog thread checks on the heartbeat, and while it is overdue samples the stack of the
+    loop's thread every `sample_interval` seconds. Once the heartbeat runs again, a lag of
+    more than `threshold` seconds is recorded as a stall, attributed to the spawner methods
+    and the Azure SDK call seen most often in its samples.
+
+    """
+    def __init__(self, loop, threshold=0.1, interval=0.05, sample_interval=None, recent=50, log=None):
+        self.loop = loop
+        self.threshold = threshold
+        self.interval = interval
+        self.sample_interval = sample_interval or threshold / 5
+        self.log = log or logging.getLogger(__name__)
+
+        self.stalls = 0
+        self.stalled_seconds = 0.0
+        self.max_stall_seconds = 0.0
+        self.by_site = {}
+        self.recent = collections.deque(maxlen=recent)
+        # Time stalled, in milliseconds, per stack (as a tuple of frames, outermost first).
+        self.stacks = collections.Counter()
+
+        self._lock = threading.Lock()
+        self._samples = []
+        self._loop_thread_id = None
+        self._next_beat = None
+        self._last_beat = None
+        self._handle = None
+        self._watchdog = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        if self._watchdog is not None:
+            return
+        self._next_beat = self._last_beat = time.monotonic()
+        self._handle = self.loop.call_soon(self._beat)
+        self._watchdog = threading.Thread(target=self._watch, name="aml-stall-watchdog", daemon=True)
+        self._watchdog.start()
+        self.log.info(f"Watching for event loop stalls of more than {self.threshold} seconds.")
+
+    def stop(self):
+        self._stopped.set()
+        if self._handle is not None:
+            self._handle.cancel()
+
+    def _beat(self):
+        now = time.monotonic()
+        self._loop_thread_id = threading.get_ident()
+        lag = max(0.0, now - self._next_beat)
+        EVENT_LOOP_LAG_SECONDS.observe(lag)
+        with self._lock:
+            samples, self._samples = self._samples, []
+            self._last_beat = now
+        if lag >= self.threshold:
+            self._record(lag, samples)
+        self._next_beat = now + self.interval
+        self._handle = self.loop.call_later(self.interval, self._beat)
+
+    def _watch(self):
+        while not self._stopped.wait(self.sample_interval):
+            if self._loop_thread_id is None:
+                continue
+            with self._lock:
+                if time.monotonic() - self._last_beat < self.interval + self.sample_interval:
+                    continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is not None:
+                stack = self._stack(frame)
+                with self._lock:
+                    self._samples.append(stack)
+
+    @staticmethod
+    def _stack(frame):
+        """Return the stack as `(module, qualname)` pairs, outermost first."""
+        stack = []
+        while frame is not None:
+            module = frame.f_globals.get("__name__", "?")
+            stack.append((module, _qualname(frame.f_code, module)))
+            frame = frame.f_back
+        stack.reverse()
+        return tuple(stack)
+
+    @staticmethod
+    def _site(stack):
+        """Return the chain of our own calls, and the outermost Azure SDK call, in `stack`."""
+        ours = [name for module, name in stack if module.split(".")[0] == OUR_PACKAGE
+                and module != __name__]
+        azure_calls = [f"{module}.{name}" for module, name in stack
+                       if module.split(".")[0] in AZURE_PACKAGES]
+        return " > ".join(ours), azure_calls[0] if azure_calls else ""
+
+    def _record(self, lag, samples):
+        sites = collections.Counter(self._site(stack) for stack in samples)
+        (spawner_site, azure_call), _ = sites.most_common(1)[0] if sites else (("", ""), 0)
+        sample_ms = self.sample_interval * 1000
+        with self._lock:
+            self.stalls += 1
+            self.stalled_seconds += lag
+            self.max_stall_seconds = max(self.max_stall_seconds, lag)
+            stats = self.by_site.setdefault((spawner_site, azure_call),
+                                            {"count": 0, "total_seconds": 0.0, "max_seconds": 0.0})
+            stats["count"] += 1
+            stats["total_seconds"] += lag
+            stats["max_seconds"] = max(stats["max_seconds"], lag)
+            for stack in samples:
+                self.stacks[stack] += sample_ms
+            self.recent.append({"time": time.time(), "seconds": lag,
+                                "spawner": spawner_site, "azure_call": azure_call})
+        self.log.warning(f"Event loop stalled for {lag:.3f} seconds in {spawner_site or 'unknown code'}"
+                         + (f", calling {azure_call}" if azure_call else "") + ".")
+
+    def stats(self):
+        """Return the aggregated stall statistics, worst call sites first."""
+        with self._lock:
+            sites = [dict(stats, spawner=spawner_site, azure_call=azure_call)
+                     for (spawner_site, azure_call), stats in self.by_site.items()]
+            sites.sort(key=lambda site: site["total_seconds"], reverse=True)
+            return {
+                "threshold_seconds": self.threshold,
+                "stalls": self.stalls,
+                "stalled_seconds": self.stalled_seconds,
+                "max_stall_seconds": self.max_stall_seconds,
+                "sites": sites,
+                "recent": list(self.recent),
+            }
+
+    def folded(self):
+        """
+        Return the sampled stacks in the "folded" format of flamegraph.pl and speedscope:
+        one line per stack, `frame;frame;frame <milliseconds stalled>`, outermost frame first.
+        """
+        with self._lock:
+            stacks = list(self.stacks.items())
+        return "".join(";".join(f"{module}:{name}" for module, name in stack) + f" {round(ms)}\n"
+                       for stack, ms in sorted(stacks))
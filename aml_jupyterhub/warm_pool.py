@@ -0,0 +1,219 @@
+"""Pools of compute instances provisioned ahead of demand."""
+
+import asyncio
+import datetime
+import hashlib
+import logging
+
+from . import sdk
+from .scheduler import BACKGROUND
+
+
+class WarmPool:
+    """
+    Compute instances of one VM size in one workspace, kept ready to be handed out.
+
+    AzureML only lets the user an instance is assigned to use its Jupyter endpoints, and the
+    assignment is fixed when the instance is created. So each instance is created for one of
+    `users` (AAD object IDs in `tenant_id`), at most one per user, and only handed out to them.
+
+    The pool aims to hold `size` instances (or the size of the first `schedule` entry that
+    matches the current time), but never more than `max_size`, or one per user. Ready instances
+    are kept stopped, or running if `running` is True.
+
+    A schedule entry looks like `{"days": [0, 1, 2, 3, 4], "hours": [8, 18], "size": 5}`,
+    where days count from Monday == 0 and hours are a half-open range in local time.
+
+    """
+    def __init__(self, workspace_key, vm_size, users=(), tenant_id=None, size=0, max_size=None,
+                 running=False, schedule=(), log=None):
+        self.workspace_key = workspace_key
+        self.vm_size = vm_size
+        self.users = list(users)
+        self.tenant_id = tenant_id
+        self.size = size
+        self.max_size = max_size
+        self.running = running
+        self.schedule = list(schedule)
+        self.log = log or logging.getLogger(__name__)
+
+        # Names are unique to the pool, so we can find our instances again after a restart.
+        digest = hashlib.md5(f"{workspace_key}{vm_size}".encode("utf-8")).hexdigest()[:6]
+        self.prefix = f"wp{digest}-"
+        self.ready = []
+        self.provisioning = set()
+        self.claimed = set()
+        # Only one refill at a time, or each would create the same missing instances.
+        self._refilling = asyncio.Lock()
+
+    def target_size(self, now=None):
+        now = now or datetime.datetime.now()
+        size = self.size
+        for entry in self.schedule:
+            start_hour, end_hour = entry.get("hours", (0, 24))
+            if now.weekday() in entry.get("days", range(7)) and start_hour <= now.hour < end_hour:
+                size = entry["size"]
+                break
+        size = min(size, len(self.users))
+        return size if self.max_size is None else min(size, self.max_size)
+
+    def owns(self, name):
+        return name.startswith(self.prefix)
+
+    def name_for(self, user_oid):
+        """The name of the pool's instance for a user, so it can be found again after a restart."""
+        return self.prefix + hashlib.md5(user_oid.encode("utf-8")).hexdigest()[:8]
+
+    def claim(self, user_oid):
+        """Hand out the user's ready instance, or return None if there isn't one."""
+        name = self.name_for(user_oid)
+        if name not in self.ready:
+            return None
+        self.ready.remove(name)
+        self.claimed.add(name)
+        return name
+
+    async def refill(self, workspace, poller, run):
+        """
+        Bring the pool towards its target size: adopt or prepare the instances we own,
+        create any that are missing, and delete any surplus.
+        """
+        async with self._refilling:
+            await self._refill(workspace, poller, run)
+
+    async def _refill(self, workspace, poller, run):
+        await poller.refresh()
+        states = {name: state.lower() for name, state in poller.states().items() if self.owns(name)}
+        ready_state = "running" if self.running else "stopped"
+
+        self.ready = [name for name in self.ready if states.get(name) == ready_state]
+        self.provisioning = set()
+        for name, state in states.items():
+            if name in self.claimed or name in self.ready:
+                continue
+            if state == ready_state:
+                self.ready.append(name)
+            elif state == "failed":
+                await self._delete(poller.instance(name), run)
+            elif state == "running":
+                await run(poller.instance(name).stop, write=True, priority=BACKGROUND)
+                self.provisioning.add(name)
+            elif state == "stopped":
+                await run(poller.instance(name).start, write=True, priority=BACKGROUND)
+                self.provisioning.add(name)
+            else:
+                self.provisioning.add(name)
+
+        target = self.target_size()
+        missing = target - len(self.ready) - len(self.provisioning)
+        if missing > 0:
+            pooled = set(states) | self.claimed | set(self.ready) | self.provisioning
+            users = [user for user in self.users if self.name_for(user) not in pooled][:missing]
+            self.log.info(f"Creating {len(users)} {self.vm_size} instances for the warm pool.")
+            # Counted before we wait for Azure, in case anyone looks at the pool meanwhile.
+            self.provisioning.update(self.name_for(user) for user in users)
+            results = await asyncio.gather(*(self._create(workspace, user, run) for user in users),
+                                           return_exceptions=True)
+            for user, result in zip(users, results):
+                if isinstance(result, Exception):
+                    self.log.warning(f"Could not create warm pool instance {self.name_for(user)}: {result}")
+                    self.provisioning.discard(self.name_for(user))
+        while len(self.ready) > target:
+            await self._delete(poller.instance(self.ready.pop()), run)
+
+    async def _create(self, workspace, user_oid, run):
+        config = sdk.ComputeInstance.provisioning_configuration(vm_size=self.vm_size,
+                                                                assigned_user_object_id=user_oid,
+                                                                assigned_user_tenant_id=self.tenant_id)
+        await run(sdk.ComputeInstance.create, workspace, self.name_for(user_oid), config,
+                  write=True, priority=BACKGROUND)
+
+    async def _delete(self, instance, run):
+        if instance is not None:
+            self.log.info(f"Deleting warm pool instance {instance.name}.")
+            await run(instance.delete, write=True, priority=BACKGROUND)
+
+
+class WarmPoolManager:
+    """
+    Keep the configured warm pools filled in the background, and hand their instances out.
+
+    `get_workspace(key)` returns the workspace for a `(subscription_id, resource_group,
+    workspace_name)` key, `poller_for(workspace)` its `ComputeStatusPoller`, and `run` makes
+    a blocking SDK call off the event loop, i.e. `AzureScheduler.call`.
+
+    """
+    def __init__(self, pool_configs, subscription_id, tenant_id, get_workspace, poller_for, run,
+                 interval=60, log=None):
+        self.get_workspace = get_workspace
+        self.poller_for = poller_for
+        self.run = run
+        self.interval = interval
+        self.log = log or logging.getLogger(__name__)
+        self.pools = {}
+        for config in pool_configs:
+            resource_group = config["resource_group"]
+            workspace_key = (subscription_id, resource_group, config.get("workspace", resource_group))
+            pool = WarmPool(workspace_key, config["vm_size"],
+                            users=config.get("users", ()),
+                            tenant_id=tenant_id,
+                            size=config.get("size", 0),
+                            max_size=config.get("max_size"),
+                            running=config.get("running", False),
+                            schedule=config.get("schedule", ()),
+                            log=self.log)
+            self.pools[(workspace_key, pool.vm_size)] = pool
+        self._task = None
+
+    def start(self):
+        """Start refilling the pools in the background, if we aren't already."""
+        if self._task is None and self.pools:
+            self._task = asyncio.ensure_future(self._refill_periodically())
+
+    async def _refill_periodically(self):
+        while True:
+            # Wait first, so the hub has loaded its spawners (and their claims) before we adopt
+            # instances left over from a previous run.
+            await asyncio.sleep(self.interval)
+            await asyncio.gather(*(self.refill(pool) for pool in self.pools.values()))
+
+    async def refill(self, pool):
+        try:
+            workspace = await self.get_workspace(pool.workspace_key)
+            await pool.refill(workspace, self.poller_for(workspace), self.run)
+        except Exception as e:
+            self.log.warning(f"Could not refill the {pool.vm_size} warm pool in {pool.workspace_key[2]}: {e}")
+
+    def _pool_owning(self, name):
+        for pool in self.pools.values():
+            if pool.owns(name):
+                return pool
+        return None
+
+    def claim(self, workspace_key, vm_size, user_oid):
+        """Return the name of the user's ready instance for this workspace and VM size, or None."""
+        pool = self.pools.get((workspace_key, vm_size))
+        name = pool.claim(user_oid) if pool else None
+        if name:
+            asyncio.ensure_future(self.refill(pool))
+        return name
+
+    def mark_claimed(self, name):
+        """Record that `name` is in use, e.g. by a spawner whose state was loaded after a restart."""
+        pool = self._pool_owning(name)
+        if pool:
+            pool.claimed.add(name)
+
+    async def release(self, name):
+        """
+        Delete an instance that was handed out. Pooled instances aren't personal, so they
+        are never reused by anyone else.
+        """
+        pool = self._pool_owning(name)
+        if pool is None:
+            return
+        workspace = await self.get_workspace(pool.workspace_key)
+        poller = self.poller_for(workspace)
+        await poller.refresh()
+        await pool._delete(poller.instance(name), self.run)
+        pool.claimed.discard(name)
@@ -0,0 +1,301 @@
+"""
+A simulated AzureML backend, for benchmarking the spawner without an Azure subscription.
+
+It stands in for the parts of the SDK that the spawner uses: `Workspace.create`,
+`ComputeInstance` (and its create/start/stop/delete and status), `ComputeTarget.list`,
+`resource_skus.list`, `resource_groups.list` and the AzureML usages in the region. Each call sleeps for a configurable latency,
+as a real (blocking) SDK call would, and is counted. Compute instances move through
+AzureML's states on a timer, e.g. Creating -> Running -> Stopping -> Stopped.
+
+Use `patch_spawner(backend)` to make the spawner modules use the fake.
+"""
+
+import collections
+import contextlib
+import random
+import threading
+import time
+from types import SimpleNamespace
+from unittest import mock
+
+# Latencies (in seconds) of each SDK call, and of each compute instance state transition.
+DEFAULT_CALL_LATENCIES = {
+    "Workspace.create": 0.5,
+    "ComputeInstance": 0.2,
+    "ComputeInstance.create": 0.5,
+    "ComputeInstance.start": 0.3,
+    "ComputeInstance.stop": 0.3,
+    "ComputeInstance.delete": 0.3,
+    "ComputeTarget.list": 0.3,
+    "resource_skus.list": 2.0,
+    "resource_groups.list": 0.3,
+    "usages.list": 0.3,
+}
+DEFAULT_TRANSITIONS = {
+    "Creating": (3.0, "Running"),
+    "Starting": (2.0, "Running"),
+    "Stopping": (1.0, "Stopped"),
+    "Deleting": (1.0, None),
+}
+
+
+class FakeComputeTargetException(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
+
+
+class FakeThrottlingError(Exception):
+    """Raised in place of a call, as Azure answers HTTP 429 when a subscription is throttled."""
+    status_code = 429
+
+    def __init__(self):
+        super().__init__("(TooManyRequests) The request is being throttled.")
+
+
+class FakeBackend:
+    """
+    The simulated state of a subscription: its resource groups, the SKUs in its region, and
+    the compute instances in each workspace. It is safe to use from many threads at once.
+
+    `vm_sizes` maps each VM size offered to its `(family, vCPUs)`, and `quotas` each family
+    to its vCPU limit. `throttle_rate` is the fraction of calls that fail as throttled, to
+    exercise retrying.
+
+    """
+    def __init__(self, resource_groups=("Pangeo-bench",), vm_sizes=None, quotas=None,
+                 call_latencies=None, transitions=None, throttle_rate=0.0, time_scale=1.0):
+        self.resource_groups = list(resource_groups)
+        self.vm_sizes = vm_sizes or {"Standard_DS1_v2": ("standardDSv2Family", 1),
+                                     "Standard_DS3_v2": ("standardDSv2Family", 4),
+                                     "Standard_D1_v2": ("standardDv2Family", 1)}
+        self.quotas = quotas or {}
+        self.call_latencies = dict(DEFAULT_CALL_LATENCIES, **(call_latencies or {}))
+        self.transitions = dict(DEFAULT_TRANSITIONS, **(transitions or {}))
+        self.throttle_rate = throttle_rate
+        self.time_scale = time_scale
+
+        self.calls = collections.Counter()
+        self.throttled = collections.Counter()
+        # (workspace name, instance name) -> [state, since]
+        self._instances = {}
+        self._instance_sizes = {}
+        self._lock = threading.Lock()
+
+    def call(self, name):
+        """Account for, and wait out the latency of, one SDK call."""
+        with self._lock:
+            self.calls[name] += 1
+            throttled = self.throttle_rate and random.random() < self.throttle_rate
+            if throttled:
+                self.throttled[name] += 1
+        time.sleep(self.call_latencies.get(name, 0) * self.time_scale)
+        if throttled:
+            raise FakeThrottlingError()
+
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    def _advance(self, key):
+        """Move the instance on through its transitions, and return its state (or None if gone)."""
+        entry = self._instances.get(key)
+        while entry is not None and entry[0] in self.transitions:
+            duration, next_state = self.transitions[entry[0]]
+            finished_at = entry[1] + duration * self.time_scale
+            if time.monotonic() < finished_at:
+                break
+            if next_state is None:
+                del self._instances[key]
+                entry = None
+            else:
+                entry[:] = [next_state, finished_at]
+        return entry[0] if entry else None
+
+    def state(self, workspace, name):
+        with self._lock:
+            return self._advance((workspace.name, name))
+
+    def names(self, workspace):
+        with self._lock:
+            keys = [key for key in self._instances if key[0] == workspace.name]
+            return [key[1] for key in keys if self._advance(key) is not None]
+
+    def set_state(self, workspace, name, state, vm_size=None):
+        with self._lock:
+            self._instances[(workspace.name, name)] = [state, time.monotonic()]
+            if vm_size:
+                self._instance_sizes[(workspace.name, name)] = vm_size
+
+    def list_usages(self, cred, subscription_id, location):
+        """Stands in for `placement.list_usages`: vCPUs used by instances that aren't stopped."""
+        self.call("usages.list")
+        used = collections.Counter()
+        with self._lock:
+            for key in list(self._instances):
+                state = self._advance(key)
+                if state not in (None, "Stopped", "Deleting"):
+                    family, vcpus = self.vm_sizes[self._instance_sizes[key]]
+                    used[family] += vcpus
+        families = {family for family, _ in self.vm_sizes.values()}
+        return {family: (used[family], self.quotas.get(family, 10 ** 6)) for family in families}
+
+    def transition(self, workspace, name, from_states, to_state):
+        """Move an instance to `to_state`, if it is in one of `from_states`. Like AzureML, refuse otherwise."""
+        with self._lock:
+            key = (workspace.name, name)
+            state = self._advance(key)
+            if state is None:
+                raise FakeComputeTargetException(f"ComputeTargetNotFound: {name}")
+            if state not in from_states:
+                raise FakeComputeTargetException(f"Conflict: {name} is {state}")
+            self._instances[key] = [to_state, time.monotonic()]
+
+
+class FakeWorkspace:
+    backend = None
+
+    def __init__(self, name, subscription_id, resource_group):
+        self.name = name
+        self.subscription_id = subscription_id
+        self.resource_group = resource_group
+
+    @classmethod
+    def create(cls, name, subscription_id, resource_group, **kwargs):
+        cls.backend.call("Workspace.create")
+        if resource_group not in cls.backend.resource_groups:
+            raise FakeComputeTargetException(f"ResourceGroupNotFound: {resource_group}")
+        return cls(name, subscription_id, resource_group)
+
+
+class FakeStatus:
+    def __init__(self, state):
+        self.state = state
+        self.errors = []
+
+
+class FakeComputeInstance:
+    backend = None
+
+    def __init__(self, workspace, name, _listed=False):
+        if not _listed:
+            self.backend.call("ComputeInstance")
+            if self.backend.state(workspace, name) is None:
+                raise FakeComputeTargetException(f"ComputeTargetNotFound: {name}")
+        self.workspace = workspace
+        self.name = name
+
+    @staticmethod
+    def provisioning_configuration(**kwargs):
+        return kwargs
+
+    @classmethod
+    def create(cls, workspace, name, provisioning_configuration):
+        cls.backend.call("ComputeInstance.create")
+        cls.backend.set_state(workspace, name, "Creating", provisioning_configuration.get("vm_size"))
+        return cls(workspace, name, _listed=True)
+
+    @property
+    def status(self):
+        state = self.backend.state(self.workspace, self.name)
+        return FakeStatus(state) if state else None
+
+    @property
+    def applications(self):
+        base = f"https://{self.name}.bench.instances.azureml.ms"
+        return [{"displayName": "Jupyter Lab", "endpointUri": f"{base}/lab"},
+                {"displayName": "Jupyter", "endpointUri": f"{base}/tree/"}]
+
+    def start(self):
+        self.backend.call("ComputeInstance.start")
+        self.backend.transition(self.workspace, self.name, ("Stopped",), "Starting")
+
+    def stop(self):
+        self.backend.call("ComputeInstance.stop")
+        self.backend.transition(self.workspace, self.name, ("Running", "Starting"), "Stopping")
+
+    def delete(self):
+        self.backend.call("ComputeInstance.delete")
+        self.backend.transition(self.workspace, self.name, ("Running", "Stopped", "Failed"), "Deleting")
+
+
+class FakeComputeTarget:
+    backend = None
+
+    @classmethod
+    def list(cls, workspace):
+        cls.backend.call("ComputeTarget.list")
+        return [FakeComputeInstance(workspace, name, _listed=True)
+                for name in cls.backend.names(workspace)]
+
+
+class _Sku:
+    resource_type = "virtualMachines"
+    restrictions = []
+
+    def __init__(self, name, family, vcpus):
+        self.name = name
+        self.family = family
+        self.capabilities = [SimpleNamespace(name="vCPUs", value=str(vcpus))]
+
+
+class _ResourceGroup:
+    def __init__(self, name):
+        self.name = name
+
+    def as_dict(self):
+        return {"name": self.name}
+
+
+class FakeClients:
+    """Stands in for `clients.AzureClients`."""
+    def __init__(self, backend):
+        self.backend = backend
+        self.cred = self.sp_cred = self.sp_auth = object()
+        self.compute_mgmt_client = mock.Mock()
+        self.compute_mgmt_client.resource_skus.list.side_effect = self._list_skus
+        self.res_mgmt_client = mock.Mock()
+        self.res_mgmt_client.resource_groups.list.side_effect = self._list_resource_groups
+
+    def _list_skus(self, filter=None):
+        self.backend.call("resource_skus.list")
+        return [_Sku(name, family, vcpus) for name, (family, vcpus) in self.backend.vm_sizes.items()]
+
+    def _list_resource_groups(self):
+        self.backend.call("resource_groups.list")
+        return [_ResourceGroup(name) for name in self.backend.resource_groups]
+
+
+@contextlib.contextmanager
+def patch_spawner(backend):
+    """Make the spawner modules use `backend` instead of AzureML, for the duration."""
+    from aml_jupyterhub import aml_spawner, placement, sdk
+
+    clients = FakeClients(backend)
+
+    async def decrypt(encrypted):
+        return encrypted
+
+    # The SDK names are looked up lazily, so they may not be in the module yet (and
+    # `mock.patch` would import the real SDK to find out).
+    fakes = {"Workspace": FakeWorkspace, "ComputeInstance": FakeComputeInstance,
+             "ComputeTarget": FakeComputeTarget, "ComputeTargetException": FakeComputeTargetException}
+    originals = {name: vars(sdk).get(name) for name in fakes}
+
+    def restore():
+        for name, value in originals.items():
+            if value is None:
+                vars(sdk).pop(name, None)
+            else:
+                setattr(sdk, name, value)
+
+    with contextlib.ExitStack() as stack:
+        for cls in (FakeWorkspace, FakeComputeInstance, FakeComputeTarget):
+            stack.enter_context(mock.patch.object(cls, "backend", backend))
+        stack.enter_context(mock.patch.object(sdk, "preload", lambda: None))
+        stack.enter_context(mock.patch.object(aml_spawner, "decrypt", decrypt))
+        stack.enter_context(mock.patch.object(placement, "list_usages", backend.list_usages))
+        stack.enter_context(mock.patch.object(aml_spawner.clients, "get_clients", lambda *args: clients))
+        stack.callback(restore)
+        for name, fake in fakes.items():
+            setattr(sdk, name, fake)
+        yield backend
@@ -0,0 +1,74 @@
+"""
+Measure how long it takes to import the spawner, as JupyterHub does whenever it starts.
+
+Each run imports `aml_jupyterhub.aml_spawner` in a fresh interpreter, e.g.
+
+    python benchmarks/import_benchmark.py --runs 5 --max-seconds 2
+
+and reports the import time, the peak memory of the interpreter, and any Azure SDK modules
+that were imported. The SDKs should only be imported once a spawner needs them, so the
+benchmark fails (exit status 1) if any were, or if the median import took longer than
+`--max-seconds`.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SDK_PACKAGES = ("azure", "azureml", "msrest", "msrestazure", "adal", "msal")
+
+IMPORT_SCRIPT = f"""
+import json, resource, sys, time
+started_at = time.perf_counter()
+import aml_jupyterhub.aml_spawner
+seconds = time.perf_counter() - started_at
+max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({{
+    "seconds": seconds,
+    # Kilobytes on Linux, bytes on macOS.
+    "max_rss_mib": max_rss / (1024 * 1024 if sys.platform == "darwin" else 1024),
+    "sdk_modules": sorted(m for m in sys.modules if m.split(".")[0] in {SDK_PACKAGES!r}),
+}}))
+"""
+
+
+def import_once():
+    output = subprocess.run([sys.executable, "-c", IMPORT_SCRIPT], cwd=ROOT, check=True,
+                            stdout=subprocess.PIPE, universal_newlines=True).stdout
+    return json.loads(output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--max-seconds", type=float, default=2.0,
+                        help="fail if the median import takes longer than this")
+    args = parser.parse_args()
+
+    runs = [import_once() for _ in range(args.runs)]
+    sdk_modules = sorted({m for run in runs for m in run["sdk_modules"]})
+    result = {
+        "runs": args.runs,
+        "import_seconds_median": round(statistics.median(run["seconds"] for run in runs), 3),
+        "import_seconds_max": round(max(run["seconds"] for run in runs), 3),
+        "max_rss_mib": round(max(run["max_rss_mib"] for run in runs), 1),
+        "sdk_modules_imported": sdk_modules,
+    }
+    print(json.dumps(result, indent=2))
+
+    failures = []
+    if result["import_seconds_median"] > args.max_seconds:
+        failures.append(f"import took {result['import_seconds_median']} seconds, threshold {args.max_seconds}")
+    if sdk_modules:
+        failures.append(f"{len(sdk_modules)} Azure SDK modules were imported with the spawner")
+    for failure in failures:
+        print(f"FAILED: {failure}", file=sys.stderr)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+"""
+Load test the AzureML spawner against a simulated AzureML backend.
+
+Each simulated user fills in the options form, then starts, polls and stops their server,
+all users at once. Nothing is sent to Azure, so this can be run anywhere, e.g.
+
+    python benchmarks/spawn_benchmark.py --users 200
+
+and reports spawns per second, event-loop lag, SDK calls per spawn, memory per spawner and
+start/stop latency percentiles. With `--thresholds benchmarks/thresholds.json` it exits with
+status 1 if any result is worse than its threshold, so regressions can be tracked from
+release to release.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_azureml import FakeBackend, patch_spawner  # noqa: E402
+
+for name in ("SUBSCRIPTION_ID", "LOCATION", "AAD_TENANT_ID", "AAD_CLIENT_ID", "AAD_CLIENT_SECRET"):
+    os.environ.setdefault(name, f"bench-{name.lower()}")
+
+from jupyterhub.objects import Server  # noqa: E402
+
+from aml_jupyterhub import redirector  # noqa: E402
+from aml_jupyterhub.aml_spawner import AMLSpawner  # noqa: E402
+from aml_jupyterhub.inflight import InflightOperations  # noqa: E402
+from aml_jupyterhub.poller import ComputeStatusPoller  # noqa: E402
+
+# Results that must be at least (min_) or at most (max_) their threshold.
+THRESHOLD_RESULTS = {
+    "min_spawns_per_second": "spawns_per_second",
+    "max_loop_lag_seconds": "loop_lag_max_seconds",
+    "max_sdk_calls_per_spawn": "sdk_calls_per_spawn",
+    "max_memory_per_spawner_kib": "memory_per_spawner_kib",
+    "max_start_latency_p99_seconds": "start_latency_p99_seconds",
+}
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class LoopLagMonitor:
+    """Measure how late the event loop wakes a task that sleeps for `interval` seconds."""
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.lags = []
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._measure())
+
+    def stop(self):
+        self._task.cancel()
+
+    async def _measure(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            started_at = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, loop.time() - started_at - self.interval))
+
+
+def reset_shared_state():
+    """Forget the hub-wide caches and registries, so each run starts from a cold hub."""
+    if AMLSpawner._stall_detector is not None:
+        AMLSpawner._stall_detector.stop()
+    for attr in ("_vm_size_cache", "_resource_group_cache", "_azure_executor", "_azure_scheduler",
+                 "_workspace_cache", "_warm_pool_manager", "_usage_cache", "_project_access_cache",
+                 "_stall_detector", "_transition_durations"):
+        setattr(AMLSpawner, attr, None)
+    AMLSpawner._prestarts.clear()
+    AMLSpawner._inflight = InflightOperations()
+    ComputeStatusPoller._pollers.clear()
+    redirector.RedirectServer._servers.clear()
+
+
+def make_spawner(i, args):
+    username = f"bench{i:05d}"
+    user = SimpleNamespace(name=username, encrypted_auth_state={"user": {"oid": f"oid-{i}"}})
+    spawner = AMLSpawner(user=user,
+                         ip="127.0.0.1",
+                         redirect_port=args.redirect_port,
+                         compute_status_interval=args.poll_interval,
+                         azure_executor_pool_size=args.pool_size,
+                         azure_read_rate_limit=args.read_rate,
+                         azure_write_rate_limit=args.write_rate)
+    spawner.server = Server(base_url=f"/user/{username}/")
+    return spawner
+
+
+async def spawn_cycle(spawner, args, results):
+    """Fill in the form, then start, poll and stop the server, timing each step."""
+    await spawner._render_options_form()
+    await spawner.options_from_form({"rg_select": [args.resource_group], "vm_select": ["Small ($)"]})
+
+    started_at = time.perf_counter()
+    try:
+        await spawner.start()
+    except Exception as e:
+        results["errors"].append(f"start: {e!r}")
+        return
+    results["start_latencies"].append(time.perf_counter() - started_at)
+
+    status = await spawner.poll()
+    if status is not None:
+        results["errors"].append(f"poll: server not running ({status})")
+
+    started_at = time.perf_counter()
+    try:
+        await spawner.stop()
+    except Exception as e:
+        results["errors"].append(f"stop: {e!r}")
+        return
+    results["stop_latencies"].append(time.perf_counter() - started_at)
+    spawner.clear_state()
+
+
+async def run(args):
+    quotas = {family: int(vcpus) for family, vcpus in (quota.split("=") for quota in args.quota)}
+    backend = FakeBackend(resource_groups=[args.resource_group],
+                          quotas=quotas,
+                          throttle_rate=args.throttle_rate,
+                          time_scale=args.time_scale)
+    results = {"start_latencies": [], "stop_latencies": [], "errors": []}
+    monitor = LoopLagMonitor()
+
+    with patch_spawner(backend):
+        reset_shared_state()
+        tracemalloc.start()
+        memory_before, _ = tracemalloc.get_traced_memory()
+        spawners = [make_spawner(i, args) for i in range(args.users)]
+        memory_after, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        monitor.start()
+        started_at = time.perf_counter()
+        await asyncio.gather(*(spawn_cycle(spawner, args, results) for spawner in spawners))
+        duration = time.perf_counter() - started_at
+        monitor.stop()
+
+        for server in redirector.RedirectServer._servers.values():
+            await server.close()
+        AMLSpawner._azure_executor.pool.shutdown(wait=False)
+
+    spawns = len(results["start_latencies"])
+    start_latencies, stop_latencies = results["start_latencies"], results["stop_latencies"]
+    return {
+        "users": args.users,
+        "spawns": spawns,
+        "errors": len(results["errors"]),
+        "duration_seconds": round(duration, 3),
+        "spawns_per_second": round(spawns / duration, 3),
+        "loop_lag_p99_seconds": round(percentile(monitor.lags, 0.99) or 0, 4),
+        "loop_lag_max_seconds": round(max(monitor.lags, default=0), 4),
+        "sdk_calls_per_spawn": round(backend.total_calls() / max(spawns, 1), 2),
+        "sdk_calls": dict(backend.calls),
+        "throttled_calls": sum(backend.throttled.values()),
+        "memory_per_spawner_kib": round((memory_after - memory_before) / args.users / 1024, 2),
+        "start_latency_p50_seconds": round(percentile(start_latencies, 0.5) or 0, 3),
+        "start_latency_p90_seconds": round(percentile(start_latencies, 0.9) or 0, 3),
+        "start_latency_p99_seconds": round(percentile(start_latencies, 0.99) or 0, 3),
+        "start_latency_mean_seconds": round(statistics.mean(start_latencies), 3) if start_latencies else 0,
+        "stop_latency_p50_seconds": round(percentile(stop_latencies, 0.5) or 0, 3),
+        "stop_latency_p99_seconds": round(percentile(stop_latencies, 0.99) or 0, 3),
+        "first_errors": results["errors"][:5],
+    }
+
+
+def check_thresholds(result, thresholds):
+    """Return a description of each result that is worse than its threshold."""
+    failures = []
+    for name, limit in thresholds.items():
+        key = THRESHOLD_RESULTS.get(name)
+        if key is None:
+            continue
+        value = result[key]
+        if name.startswith("min_") and value < limit or name.startswith("max_") and value > limit:
+            failures.append(f"{key} = {value}, threshold {name} = {limit}")
+    if result["errors"]:
+        failures.append(f"{result['errors']} spawn cycles failed")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50, help="number of concurrent users")
+    parser.add_argument("--resource-group", default="Pangeo-bench")
+    parser.add_argument("--time-scale", type=float, default=1.0,
+                        help="multiply every simulated latency and state transition time by this")
+    parser.add_argument("--throttle-rate", type=float, default=0.0,
+                        help="fraction of SDK calls that are throttled (HTTP 429)")
+    parser.add_argument("--quota", action="append", default=[], metavar="FAMILY=VCPUS",
+                        help="AzureML vCPU quota of a VM family, e.g. standardDSv2Family=24")
+    parser.add_argument("--poll-interval", type=int, default=1, help="c.AMLSpawner.compute_status_interval")
+    parser.add_argument("--pool-size", type=int, default=16, help="c.AMLSpawner.azure_executor_pool_size")
+    parser.add_argument("--read-rate", type=float, default=100, help="c.AMLSpawner.azure_read_rate_limit")
+    parser.add_argument("--write-rate", type=float, default=100, help="c.AMLSpawner.azure_write_rate_limit")
+    parser.add_argument("--redirect-port", type=int, default=0,
+                        help="port of the redirect server; 0 picks a free one")
+    parser.add_argument("--thresholds", help="JSON file of thresholds, keyed by user count")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    result = asyncio.get_event_loop().run_until_complete(run(args))
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+    if args.thresholds:
+        with open(args.thresholds) as f:
+            thresholds = json.load(f)
+        # Use the thresholds for the largest user count that this run reaches.
+        scales = [int(users) for users in thresholds if int(users) <= args.users]
+        failures = check_thresholds(result, thresholds[str(max(scales))]) if scales else []
+        for failure in failures:
+            print(f"FAILED: {failure}", file=sys.stderr)
+        sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()